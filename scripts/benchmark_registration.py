@@ -0,0 +1,131 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from visual_servoing.registration import (ICPRegistration, MultiScaleICPRegistration, SDFRegistration,
+                                          transform_points)
+from visual_servoing.sdf import load_sdf
+
+try:
+    import open3d as o3d
+except ImportError:
+    o3d = None
+
+
+def surface_points(model_sdf, registration):
+    '''
+    Moves the model points onto the zero level set of the SDF, the model points are voxel centers a few
+    millimeters inside the surface while a depth camera sees the surface itself
+    '''
+    points = np.array(model_sdf['points'], dtype=np.float64)
+    for _ in range(3):
+        in_bounds, field = registration.interpolate(points)
+        gradient = field[:, 1:4]
+        step = field[:, 0] / np.maximum(np.sum(gradient ** 2, axis=1), 1e-3)
+        points[in_bounds] -= step[:, None] * gradient
+    return points
+
+
+def random_transform(rng, max_angle, max_translation):
+    '''
+    Creates a 4x4 homogenous TF with a random rotation and translation up to the given magnitudes
+    '''
+    axis = rng.normal(size=3)
+    T = np.eye(4)
+    T[0:3, 0:3], _ = cv2.Rodrigues(axis / np.linalg.norm(axis) * rng.uniform(0, max_angle))
+    direction = rng.normal(size=3)
+    T[0:3, 3] = direction / np.linalg.norm(direction) * rng.uniform(0, max_translation)
+    return T
+
+
+def partial_view(rng, points, noise, outliers):
+    '''
+    Keeps the half of the surface facing a random view direction, adds gaussian noise and uniform outliers
+    '''
+    center = np.mean(points, axis=0)
+    view = rng.normal(size=3)
+    scene = points[(points - center) @ view > 0]
+    scene = scene + rng.normal(0, noise, scene.shape)
+    n_outliers = int(outliers * len(scene))
+    low, high = np.min(points, axis=0), np.max(points, axis=0)
+    return np.vstack((scene, rng.uniform(low, high, (n_outliers, 3))))
+
+
+def pose_error(T_est, T_true):
+    '''
+    Translation error in meters and rotation error in degrees between two TFs
+    '''
+    delta = np.linalg.inv(T_true) @ T_est
+    rvec, _ = cv2.Rodrigues(delta[0:3, 0:3])
+    return np.linalg.norm(delta[0:3, 3]), np.degrees(np.linalg.norm(rvec))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the registration engines on synthetic gripper views")
+    parser.add_argument("--trials", type=int, default=50)
+    parser.add_argument("--max-angle", type=float, default=15.0, help="initial rotation error in degrees")
+    parser.add_argument("--max-translation", type=float, default=0.02, help="initial translation error in meters")
+    parser.add_argument("--noise", type=float, default=0.001, help="depth noise in meters")
+    parser.add_argument("--outliers", type=float, default=0.05, help="outliers as a fraction of the view")
+    parser.add_argument("--max-distance", type=float, default=0.1)
+    parser.add_argument("--budget", type=float, default=None, help="per registration deadline in milliseconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    model_sdf = load_sdf("points_and_sdf.pkl")
+    model = np.array(model_sdf['points'], dtype=np.float64)
+
+    # build every engine up front, their one time setup is not part of the per frame cost
+    sdf_registration = SDFRegistration(model_sdf['sdf'], model_sdf['origin_point'], model_sdf['res'])
+    engines = {
+        "icp point_to_point": ICPRegistration(model, 'point_to_point'),
+        "icp point_to_plane": ICPRegistration(model, 'point_to_plane'),
+        "icp generalized": ICPRegistration(model, 'generalized'),
+        "multiscale point_to_plane": MultiScaleICPRegistration(model, 'point_to_plane'),
+        "sdf gauss-newton": sdf_registration,
+    }
+    if o3d is not None:
+        o3d_model = o3d.geometry.PointCloud()
+        o3d_model.points = o3d.utility.Vector3dVector(model)
+
+    rng = np.random.default_rng(args.seed)
+    surface = surface_points(model_sdf, sdf_registration)
+    results = {name: [] for name in (["open3d point_to_point"] if o3d is not None else []) + list(engines)}
+    for _ in range(args.trials):
+        # the scene is the model surface seen through an unknown pose, registration must recover its inverse
+        T_true = random_transform(rng, np.radians(args.max_angle), args.max_translation)
+        scene = transform_points(np.linalg.inv(T_true), partial_view(rng, surface, args.noise, args.outliers))
+
+        if o3d is not None:
+            o3d_scene = o3d.geometry.PointCloud()
+            o3d_scene.points = o3d.utility.Vector3dVector(scene)
+            start = time.perf_counter()
+            reg = o3d.pipelines.registration.registration_icp(
+                o3d_scene, o3d_model, args.max_distance, np.eye(4),
+                o3d.pipelines.registration.TransformationEstimationPointToPoint()
+            )
+            results["open3d point_to_point"].append(
+                (time.perf_counter() - start, *pose_error(reg.transformation, T_true), np.nan, False))
+
+        for name, engine in engines.items():
+            start = time.perf_counter()
+            deadline = None if args.budget is None else start + args.budget / 1000
+            reg = engine.register(scene, args.max_distance, np.eye(4), deadline=deadline)
+            results[name].append((time.perf_counter() - start, *pose_error(reg.transformation, T_true),
+                                  reg.iterations, reg.budget_hit))
+
+    print(f"{'engine':28s} {'mean ms':>8s} {'p95 ms':>8s} {'iters':>6s} {'trans mm':>9s} {'rot deg':>8s} "
+          f"{'success':>8s} {'budget':>7s}")
+    for name, rows in results.items():
+        rows = np.array(rows)
+        # a registration succeeds when it is within 5 mm and 2 degrees of the true pose
+        success = np.mean((rows[:, 1] < 0.005) & (rows[:, 2] < 2.0))
+        print(f"{name:28s} {1000 * np.mean(rows[:, 0]):8.2f} {1000 * np.percentile(rows[:, 0], 95):8.2f} "
+              f"{np.mean(rows[:, 3]):6.1f} {1000 * np.median(rows[:, 1]):9.2f} {np.median(rows[:, 2]):8.2f} "
+              f"{success:8.0%} {np.mean(rows[:, 4]):7.0%}")
+
+
+if __name__ == "__main__":
+    main()
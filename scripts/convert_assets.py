@@ -0,0 +1,38 @@
+import argparse
+
+import numpy as np
+
+from visual_servoing.assets import Asset, convert_pickle
+from visual_servoing.sdf import load_sdf
+
+
+def check_asset(pkl_path, directory):
+    '''
+    Verifies that the converted asset holds the same values as the pickle
+    '''
+    original = load_sdf(pkl_path)
+    asset = Asset(directory)
+    for key, value in original.items():
+        if isinstance(value, dict):
+            assert list(value.keys()) == list(asset[key].keys()), key
+            for name in value:
+                assert np.array_equal(value[name], asset[key][name]), f"{key}/{name}"
+        elif isinstance(value, np.ndarray):
+            assert np.array_equal(value, asset[key]) and value.dtype == asset[key].dtype, key
+        else:
+            assert value == asset[key], key
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert model pickles to the memory mapped asset format")
+    parser.add_argument("pickles", nargs="*", default=["points_and_sdf.pkl", "robot_points.pkl"])
+    args = parser.parse_args()
+
+    for pkl_path in args.pickles:
+        directory = convert_pickle(pkl_path)
+        check_asset(pkl_path, directory)
+        print(f"converted {pkl_path} -> {directory}")
+
+
+if __name__ == "__main__":
+    main()
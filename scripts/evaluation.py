@@ -9,15 +9,17 @@ import os
 import pickle
 import shutil
 
-import open3d as o3d
 
 from visual_servoing.arm_robot import ArmRobot
-from visual_servoing.camera import Camera, PyBulletCamera
+from visual_servoing.camera import AsyncCamera, Camera, PyBulletCamera
+from visual_servoing.depth_noise import DepthNoiseModel
 from visual_servoing.icp_pbvs import ICPPBVS
+from visual_servoing.marker_pbvs import MarkerPBVS
 from visual_servoing.pbvs import PBVS
 from visual_servoing.pbvs_loop import PybulletPBVSLoop
 from visual_servoing.utils import *
 from visual_servoing.victor import Victor
+from visual_servoing.visualization import VisualizationService
 
 
 def create_target_tf(target_pos, target_rot):
@@ -52,55 +54,6 @@ def get_eef_gt_tf(victor, camera, world_relative=False):
         return Tce
 
 
-def image_augmentation(numpy_depth):
-    '''
-    Adds depth noise (TODO needs work!!!!)
-    '''
-    # Get to btween 0 and 255
-    # depth = numpy_depth + np.min(numpy_depth)
-    synthetic_data = True
-    if synthetic_data:
-        # depth /= np.max(depth)
-        depth = 255.0 * numpy_depth
-        depth = depth.astype(np.uint8)
-        edges = cv2.Canny(depth, 100, 200)
-        ex, ey = np.where(edges == 255)
-        num_edge = len(ex)
-        min_edge = int(0.5 * num_edge)
-        num_disturbances = np.random.randint(min_edge, num_edge)
-        perm = np.random.permutation(np.arange(0, num_edge))
-        pixels_to_disturb = perm[:num_disturbances]
-        idx = (ex[pixels_to_disturb], ey[pixels_to_disturb])
-        eones = np.ones(depth.shape)
-        eones[idx] = 0.0
-
-        # Add edge noise
-        numpy_depth *= eones
-
-    # Get area where depth beyond threshold (background)
-    background_idx = np.where(np.logical_or(numpy_depth > 2 / 2.6, numpy_depth == 0))
-    bones = np.ones(numpy_depth.shape)
-    bones[background_idx] = 0.0
-
-    # Salt and pepper noise to background
-    bx, by = background_idx
-    max_disturbances = int(0.2 * len(bx))
-    min_disturbances = int(0.1 * len(bx))
-    num_snp = np.random.randint(min_disturbances, max_disturbances)
-    b_permutation = np.random.permutation(len(bx))
-    snp_idx = (bx[b_permutation[:num_snp]], by[b_permutation[:num_snp]])
-    snp_noise_depth = 1.0 + 0.1 * np.random.randn(num_snp)
-
-    # Subtract background
-    numpy_depth *= bones
-
-    # Add snp noise
-    if synthetic_data:
-        numpy_depth[snp_idx] = snp_noise_depth
-
-    numpy_depth += 0.05 * np.random.normal(size=numpy_depth.shape)
-    return numpy_depth
-
 class EvalPBVSLoop(PybulletPBVSLoop):
     def __init__(self,
                  pbvs: PBVS,
@@ -110,10 +63,15 @@ class EvalPBVSLoop(PybulletPBVSLoop):
                  pbvs_hz: float,
                  sim_hz: float,
                  config,
-                 result_dict):
+                 result_dict,
+                 noise_model: DepthNoiseModel = None,
+                 vis: VisualizationService = None):
         super().__init__(pbvs, camera, robot, side, pbvs_hz, sim_hz, config)
         self.result_dict = result_dict
-        self.pose_est_uids = None
+        self.noise_model = noise_model
+        self.vis = vis
+        # the camera image is shown when visualizing
+        self.capture_rgb = self.capture_rgb or config['vis']
         self.target_uids = None
 
     def on_check_is_done(self, is_timed_out, target_reached):
@@ -122,47 +80,59 @@ class EvalPBVSLoop(PybulletPBVSLoop):
 
     def get_camera_image(self):
         rgb, depth = super().get_camera_image()
-        true_depth = self.camera.get_true_depth(depth).reshape(depth.shape)
-        if (self.config['use_depth_noise']):
-            min_val = np.min(true_depth)
-            max_val = np.max(true_depth)
-            rng = max_val - min_val
-            # noisy_depth = image_augmentation((true_depth - min_val)/rng)
-            noisy_depth = image_augmentation(true_depth)
-            # noisy_depth = (noisy_depth * rng + min_val)
-        else:
-            noisy_depth = true_depth
-        noisy_depth_buffer = self.camera.get_depth_buffer(noisy_depth).reshape(depth.shape)
-
-        if self.config['vis']:
-            cv2.imshow("Camera", cv2.resize(rgb, (1280 // 5, 800 // 5)))
-            cv2.waitKey(1)
-
-        return rgb, noisy_depth_buffer
+        # marker PBVS captures no depth
+        if (self.noise_model is not None and depth is not None):
+            if self.camera.metric_depth:
+                # background capture can hand out the same frame twice, so noise goes on a copy
+                if isinstance(self.camera, AsyncCamera):
+                    depth = depth.copy()
+                depth = self.noise_model.apply(depth)
+            else:
+                # get_true_depth is OpenGL camera z, which is the negated metric depth
+                metric_depth = -self.camera.get_true_depth(depth).reshape(depth.shape)
+                noisy_depth = self.noise_model.apply(metric_depth)
+                depth = self.camera.get_depth_buffer(-noisy_depth).reshape(depth.shape)
+
+        if self.vis is not None and rgb is not None:
+            self.vis.publish_image("Camera", rgb, (1280 // 5, 800 // 5))
+
+        return rgb, depth
 
     def on_after_step_pbvs(self, Twe):
         super().on_after_step_pbvs(Twe)
 
-        # draw debug stuff
-        if self.config['vis']:
-            erase_pos(self.pose_est_uids)
-            self.pose_est_uids = draw_pose(Twe[0:3, 3], Twe[0:3, 0:3], mat=True)
+        # draw debug stuff, visualizations are rendered here on the main thread
+        if self.vis is not None:
+            self.vis.publish_pose("estimate", Twe)
+            self.vis.poll()
 
         # populate results
-        self.result_dict["seg_cloud"].append(np.asarray(self.pbvs.pcl.points))
+        if isinstance(self.pbvs, ICPPBVS):
+            self.result_dict["seg_cloud"].append(np.asarray(self.pbvs.pcl.points))
+        # only registration based estimators have registration diagnostics
+        if getattr(self.pbvs, "last_registration", None) is not None:
+            self.result_dict["registration"].append(self.pbvs.last_registration.get_diagnostics())
         self.result_dict["est_eef_pose"].append(Twe)
         eef_gt = get_eef_gt_tf(self.robot, self.camera, True)
         self.result_dict["gt_eef_pose"].append(eef_gt)
         self.result_dict["joint_config"].append(self.robot.get_arm_joint_configs())
 
 
-def run_servoing(pbvs, camera, victor, target, config, result_dict):
-    loop = EvalPBVSLoop(pbvs, camera, victor, "left", config['pbvs_hz'], config['sim_hz'], config, result_dict) 
+def run_servoing(pbvs, camera, victor, target, config, result_dict, noise_model=None, vis=None):
+    if (config['async_capture']):
+        # the loop reads frames captured in the background, pbvs keeps using the camera itself
+        camera = AsyncCamera(camera, rgb=pbvs.uses_rgb or config['vis'], depth=pbvs.uses_depth)
+    loop = EvalPBVSLoop(pbvs, camera, victor, "left", config['pbvs_hz'], config['sim_hz'], config, result_dict,
+                        noise_model, vis)
     if (config['vis']):
         cam_inv = np.linalg.inv(camera.get_view())
         draw_pose(target[0:3, 3], target[0:3, 0:3], mat=True)
         draw_pose(cam_inv[0:3, 3], cam_inv[0:3, 0:3], mat=True)
-    loop.run(target)
+    try:
+        loop.run(target)
+    finally:
+        if (config['async_capture']):
+            camera.stop()
 
 
 def main():
@@ -173,9 +143,6 @@ def main():
 
     result_dict = {"traj": []}
 
-    vis = o3d.visualization.Visualizer()
-    vis.create_window()
-
     use_aruco = True if config['eef_perception_type'] == "aruco" else False
 
     # Executes servoing for all the servo configs provided
@@ -184,9 +151,12 @@ def main():
         # Create objects for visual servoing
         client = p.connect(p.GUI)
         victor = Victor(servo_config, config['twist_execution_noise'])
-        camera = PyBulletCamera(np.array(servo_config['camera_pos']), np.array(servo_config['camera_look']), p.ER_BULLET_HARDWARE_OPENGL)
+        camera = PyBulletCamera(np.array(servo_config['camera_pos']), np.array(servo_config['camera_look']), p.ER_BULLET_HARDWARE_OPENGL,
+                                metric_depth=True, dtype=config['pbvs_settings']['dtype'])
         target = create_target_tf(np.array(servo_config['target_pos']), np.array(servo_config['target_rot'])) 
         pbvs = None
+        # debug visualizations are prepared off the control loop, PyBullet debug lines belong to this connection
+        vis = VisualizationService(config['vis_hz'], enabled=config['vis'])
 
         if(use_aruco):
             tag_ids, tag_geometry = victor.get_tag_geometry()
@@ -196,10 +166,36 @@ def main():
                 tag_ids,
                 tag_geometry,
                 None,
-                None)
+                None,
+                track_roi=config['marker_settings']['track_roi'],
+                roi_padding=config['marker_settings']['roi_padding'],
+                roi_min_padding=config['marker_settings']['roi_min_padding'],
+                pyramid=config['marker_settings']['pyramid'],
+                min_marker_size=config['marker_settings']['min_marker_size'],
+                max_pyramid_level=config['marker_settings']['max_pyramid_level'],
+                klt_tracking=config['marker_settings']['klt_tracking'],
+                redetect_interval=config['marker_settings']['redetect_interval'],
+                klt_max_error=config['marker_settings']['klt_max_error'],
+                klt_padding=config['marker_settings']['klt_padding'],
+                debug=config['vis'],
+                vis=vis)
         else:
+            budget = config['pbvs_settings']['registration_budget']
             pbvs = ICPPBVS(camera, 1, 1,  
-                config['pbvs_settings']['max_joint_velo'], get_eef_gt_tf(victor, camera), config['pbvs_settings']['seg_range'], debug=True, vis=vis) 
+                config['pbvs_settings']['max_joint_velo'], get_eef_gt_tf(victor, camera), config['pbvs_settings']['seg_range'], debug=config['vis'], vis=vis,
+                use_roi=config['pbvs_settings']['use_roi'], dtype=config['pbvs_settings']['dtype'],
+                coarse_level=config['pbvs_settings']['coarse_level'], pooling=config['pbvs_settings']['pooling'],
+                seg_backend=config['pbvs_settings']['seg_backend'],
+                icp_estimator=config['pbvs_settings']['icp_estimator'],
+                multiscale_icp=config['pbvs_settings']['multiscale_icp'],
+                registration=config['pbvs_settings']['registration'],
+                registration_budget=None if budget is None else budget / config['pbvs_hz'],
+                plateau_iterations=config['pbvs_settings']['plateau_iterations'],
+                plateau_rmse=config['pbvs_settings']['plateau_rmse'],
+                tracking_monitor=config['pbvs_settings']['tracking_monitor'],
+                relocalization=config['pbvs_settings']['relocalization'],
+                velocity_weight=config['pbvs_settings']['velocity_weight'],
+                mask_refresh=config['pbvs_settings']['mask_refresh'])
         
         # Create entry for this trajectory in result
         result_dict[f"traj"].append(
@@ -208,6 +204,7 @@ def main():
                 "est_eef_pose":    [],
                 "gt_eef_pose":     [],
                 "seg_cloud":       [],
+                "registration":    [],
                 "camera_to_world": np.linalg.inv(camera.get_view()),
                 "victor_to_world": np.eye(4),
                 "target_pose":     target,
@@ -215,8 +212,27 @@ def main():
             }
         )
 
+        # Depth noise is seeded per trajectory so every run is reproducible
+        noise_model = None
+        if (config['use_depth_noise']):
+            noise_config = config['depth_noise']
+            noise_model = DepthNoiseModel(noise_config['seed'] + i,
+                                          edge_dropout=noise_config['edge_dropout'],
+                                          snp_fraction=noise_config['snp_fraction'],
+                                          background_depth=noise_config['background_depth'],
+                                          gaussian_std=noise_config['gaussian_std'],
+                                          dtype=config['pbvs_settings']['dtype'])
+
         # Do visual servoing and record results
-        run_servoing(pbvs, camera, victor, target, config, result_dict[f'traj'][-1])
+        run_servoing(pbvs, camera, victor, target, config, result_dict[f'traj'][-1], noise_model, vis)
+        vis.stop()
+        if (not use_aruco):
+            stats = pbvs.registration_stats
+            result_dict[f'traj'][-1]["registration_stats"] = dict(stats)
+            print(f"registration hit its budget in {stats['budget_hits']} of {stats['frames']} frames "
+                  f"({stats['coarse_budget_hits']} in the coarse pass), ran {stats['iterations']} iterations "
+                  f"plus {stats['coarse_iterations']} coarse ones, lost track in {stats['lost']} and relocalized "
+                  f"{stats['relocalized']} times")
 
         # Destroy GUI when done
         p.disconnect()
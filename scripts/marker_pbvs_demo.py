@@ -9,6 +9,7 @@ from visual_servoing.pbvs import *
 from visual_servoing.camera import *
 from visual_servoing.marker_pbvs import *
 from visual_servoing.pbvs_loop import PybulletPBVSLoop, AbstractPBVSLoop
+from visual_servoing.visualization import VisualizationService
 import time
 import matplotlib.pyplot as plt
 import numpy as np
@@ -55,10 +56,9 @@ Two[0:3, 0:3] = np.array(p.getMatrixFromQuaternion(p.getQuaternionFromEuler((np.
 class MarkerValLoop(PybulletPBVSLoop):
 
     def __init__(self, pbvs: PBVS, camera: Camera, robot: ArmRobot, side: str, pbvs_hz: float, sim_hz: float,
-                 config ):
+                 config, vis: VisualizationService):
         super().__init__(pbvs, camera, robot, side, pbvs_hz, sim_hz, config)
-        self.uids_eef_marker = None
-        self.uids_target_marker = None
+        self.vis = vis
         self.pos_errors = []
         self.rot_errors = []
 
@@ -81,16 +81,10 @@ class MarkerValLoop(PybulletPBVSLoop):
     def on_after_step_pbvs(self, Twe):
         super().on_after_step_pbvs(Twe)
 
-        # Visualize estimated end effector pose 
-        if (self.uids_eef_marker is not None):
-            erase_pos(self.uids_eef_marker)
-        self.uids_eef_marker = draw_pose(Twe[0:3, 3], Twe[0:3, 0:3], mat=True)
-
-        # Visualize target pose 
-        if (self.uids_target_marker is not None):
-            erase_pos(self.uids_target_marker)
-        self.uids_target_marker = draw_pose(Two[0:3, 3], Two[0:3, 0:3], mat=True)
-        cv2.waitKey(1)
+        # Visualize estimated end effector pose and target pose
+        self.vis.publish_pose("eef", Twe)
+        self.vis.publish_pose("target", Two)
+        self.vis.poll()
 
         # Errors 
         truth = self.get_eef_gt()
@@ -102,14 +96,17 @@ class MarkerValLoop(PybulletPBVSLoop):
 def main():
     # Objects needed to do PBVS
     camera = PyBulletCamera(camera_eye=np.array([0.7, -0.8, 0.5]), camera_look=np.array([0.7, 0.0, 0.2]))
-    pbvs = MarkerPBVS(camera, 1, 1, 1.5, np.eye(4), ids, tag_geometry, ids2, tag_geometry)
+    vis = VisualizationService()
+    pbvs = MarkerPBVS(camera, 1, 1, 1.5, np.eye(4), ids, tag_geometry, ids2, tag_geometry, track_roi=True,
+                      pyramid=True, klt_tracking=True, vis=vis)
     val = Val([0.0, 0.0, -0.5])
     loop = MarkerValLoop(pbvs, camera, val, "left", 10, 240, {
         "timeout": 60,
         "max_pos_error": 0.03, 
         "max_rot_error": 0.1, 
-    }) 
+    }, vis)
     loop.run(Two)
+    vis.stop()
 
     # Plot ground truth vs predicted poses at each iteration of the loop
     fig, (ax1, ax2) = plt.subplots(2, 1)
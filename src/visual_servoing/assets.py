@@ -0,0 +1,137 @@
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+from visual_servoing.sdf import load_sdf
+
+ASSET_FORMAT = "visual_servoing_asset"
+ASSET_VERSION = 1
+HEADER_NAME = "header.json"
+
+# arrays up to this size are stored in the JSON header instead of their own .npy file
+HEADER_ARRAY_SIZE = 16
+
+# process wide cache of opened assets, keyed by absolute path, so every instance shares the same pages
+asset_cache = {}
+
+
+def asset_dir(path):
+    """ Binary asset directory of a pickle path, e.g. points_and_sdf.pkl -> points_and_sdf """
+    root, ext = os.path.splitext(path)
+    return root if ext == ".pkl" else path
+
+
+def encode_value(value):
+    if isinstance(value, np.ndarray):
+        return {"array": value.tolist(), "dtype": str(value.dtype)}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict) and "array" in value:
+        return np.array(value["array"], dtype=value["dtype"])
+    return value
+
+
+def convert_pickle(pkl_path, out_dir=None):
+    """
+    Convert a model pickle to the binary asset format: one .npy file per array and a JSON header holding the
+    format version, scalars, small arrays, and the names and offsets of dicts of arrays, which are stored
+    concatenated in a single .npy file
+
+    Args:
+        pkl_path: path of the pickle, e.g. points_and_sdf.pkl or robot_points.pkl
+        out_dir: directory to write the asset to, defaults to the pickle path without extension
+
+    Returns:
+        the asset directory
+    """
+    out_dir = asset_dir(pkl_path) if out_dir is None else out_dir
+    os.makedirs(out_dir, exist_ok=True)
+    data = load_sdf(pkl_path)
+
+    header = {"format": ASSET_FORMAT, "version": ASSET_VERSION, "values": {}, "arrays": {}, "groups": {}}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            names = list(value.keys())
+            arrays = [np.asarray(value[name]) for name in names]
+            offsets = np.cumsum([0] + [len(array) for array in arrays]).tolist()
+            np.save(os.path.join(out_dir, f"{key}.npy"), np.concatenate(arrays))
+            header["groups"][key] = {"file": f"{key}.npy", "names": names, "offsets": offsets}
+        elif isinstance(value, np.ndarray) and value.size > HEADER_ARRAY_SIZE:
+            np.save(os.path.join(out_dir, f"{key}.npy"), value)
+            header["arrays"][key] = f"{key}.npy"
+        else:
+            header["values"][key] = encode_value(value)
+
+    with open(os.path.join(out_dir, HEADER_NAME), "w") as f:
+        json.dump(header, f, indent=2)
+    return out_dir
+
+
+class Asset(Mapping):
+    """
+    Read only view of a binary asset with the same keys as the pickle it was converted from. Arrays are
+    memory mapped on first access, dicts of arrays are returned as dicts of views into one mapped array
+
+    Args:
+        path: asset directory containing header.json
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, HEADER_NAME), "r") as f:
+            self.header = json.load(f)
+        if self.header.get("format") != ASSET_FORMAT or self.header.get("version") != ASSET_VERSION:
+            raise ValueError(f"{path} is not a version {ASSET_VERSION} asset, convert it again")
+        self.loaded = {}
+
+    def get_array(self, file):
+        return np.load(os.path.join(self.path, file), mmap_mode="r")
+
+    def __getitem__(self, key):
+        if key in self.loaded:
+            return self.loaded[key]
+        if key in self.header["values"]:
+            value = decode_value(self.header["values"][key])
+        elif key in self.header["arrays"]:
+            value = self.get_array(self.header["arrays"][key])
+        elif key in self.header["groups"]:
+            group = self.header["groups"][key]
+            array = self.get_array(group["file"])
+            offsets = group["offsets"]
+            value = {name: array[offsets[i]:offsets[i + 1]] for i, name in enumerate(group["names"])}
+        else:
+            raise KeyError(key)
+        self.loaded[key] = value
+        return value
+
+    def __iter__(self):
+        for section in ("values", "arrays", "groups"):
+            yield from self.header[section]
+
+    def __len__(self):
+        return sum(len(self.header[section]) for section in ("values", "arrays", "groups"))
+
+
+def load_asset(path):
+    """
+    Open a model asset once per process, later calls return the same instance. Uses the converted binary
+    asset when it exists and falls back to unpickling, see scripts/convert_assets.py
+
+    Args:
+        path: pickle path, e.g. points_and_sdf.pkl, or asset directory
+
+    Returns:
+        Asset, or dict when only the pickle exists
+    """
+    key = os.path.abspath(path)
+    if key not in asset_cache:
+        directory = asset_dir(path)
+        if os.path.exists(os.path.join(directory, HEADER_NAME)):
+            asset_cache[key] = Asset(directory)
+        else:
+            asset_cache[key] = load_sdf(path)
+    return asset_cache[key]
@@ -1,3 +1,6 @@
+import threading
+import time
+
 import numpy as np
 import pybullet as p
 
@@ -11,15 +14,33 @@ from sensor_msgs.msg import Image
 
 
 class Camera:
-    def __init__(self, camera_eye, camera_look, image_dim):
+    # signs of the x, y and z axes of the OpenCV optical frame (z forward, y down) in the frame point clouds are
+    # expressed in
+    optical_axes = np.array([1.0, 1.0, 1.0])
+
+    def __init__(self, camera_eye, camera_look, image_dim, metric_depth=False, dtype=np.float64):
         self.camera_eye = camera_eye
         self.camera_look = camera_look
         self.image_dim = image_dim
+        # get_image returns depth in meters along the optical axis instead of the native depth format
+        self.metric_depth = metric_depth
+        # floating point type of depth images, rays and point clouds
+        self.dtype = np.dtype(dtype)
+        # ray tables by pyramid level
+        self.rays = {}
+        # preallocated image buffers by name, reused across frames
+        self.buffers = {}
+        # closest depth in meters the camera sees
+        self.near = 0.0
 
     def get_intrinsics(self):
         """Return OpenCV style intrinsics 3x3"""
         raise NotImplementedError()
 
+    def get_depth_intrinsics(self):
+        """Return OpenCV style intrinsics 3x3 of the depth image, the same as get_intrinsics for aligned depth"""
+        return self.get_intrinsics()
+
     def get_distortion(self):
         raise NotImplementedError()
 
@@ -31,55 +52,248 @@ class Camera:
         """Get OpenGL style view matrix 4x4"""
         raise NotImplementedError()
 
-    def get_image(self):
-        """Return RGB image and depth image"""
+    def get_image(self, rgb=True, depth=True):
+        """
+        Return RGB image and depth image, depth is metric if self.metric_depth is set
+
+        Args:
+            rgb: capture the color image, None is returned in its place otherwise
+            depth: capture the depth image, None is returned in its place otherwise
+
+        Returns:
+            rgb, depth: images that may be buffers owned by the camera and overwritten by the next call
+        """
         raise NotImplementedError()
 
-    def get_xyz(self, u, v, depth):
-        """ Retrieve pointcloud point from depth and image pt """
+    def get_buffer(self, name, shape, dtype):
+        """ Retrieve a preallocated image buffer owned by the camera, reallocated only if its shape or dtype changes """
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[name] = buffer
+        return buffer
+
+    def get_metric_depth(self, depth):
+        """ Convert a depth image returned by get_image to meters along the optical axis """
         raise NotImplementedError()
 
-    def get_pointcloud(self, depth):
-        """ Retrieve pointcloud from depth """
+    def compute_rays(self):
+        """ Compute [3, h * w] per pixel rays in camera frame, scaled to unit depth along the optical axis """
         raise NotImplementedError()
 
+    def get_rays(self, level=0):
+        """
+        Retrieve the cached [3, h * w] ray table of a pyramid level, a point is its pixel's metric depth times its ray
+
+        Args:
+            level: pyramid level, pixel (i, j) of level l sits at pixel (2^l i + 2^(l-1), 2^l j + 2^(l-1)) of level 0
+        """
+        if level not in self.rays:
+            if level == 0:
+                self.rays[level] = self.compute_rays()
+            else:
+                stride = 2 ** level
+                w, h = self.image_dim
+                rays = self.get_rays(0).reshape(3, h, w)[:, stride // 2::stride, stride // 2::stride]
+                self.rays[level] = np.ascontiguousarray(rays[:, :h // stride, :w // stride]).reshape(3, -1)
+        return self.rays[level]
+
+    def decimate(self, depth, level, pooling=None):
+        """
+        Downsample a depth image by 2^level in each direction
+
+        Args:
+            depth: [h, w] depth image, rows and columns that do not fill a whole block are dropped
+            level: pyramid level
+            pooling: None to take the pixel matching the level's ray table, 'min' to keep the closest
+                valid (nonzero) depth of each block or 'median' for the median of each block
+
+        Returns:
+            [h / 2^level, w / 2^level] depth image
+        """
+        stride = 2 ** level
+        h, w = depth.shape[0] // stride, depth.shape[1] // stride
+        if pooling is None:
+            return depth[stride // 2::stride, stride // 2::stride][:h, :w]
+        blocks = depth[:h * stride, :w * stride].reshape(h, stride, w, stride)
+        if pooling == 'min':
+            # zero marks a missing reading on real sensors
+            blocks = np.where(blocks > 0, blocks, np.inf)
+            pooled = blocks.min(axis=(1, 3))
+            pooled[np.isinf(pooled)] = 0
+            return pooled.astype(depth.dtype, copy=False)
+        if pooling == 'median':
+            blocks = blocks.transpose(0, 2, 1, 3).reshape(h, w, stride * stride)
+            return np.median(blocks, axis=-1).astype(depth.dtype, copy=False)
+        raise ValueError(f"unknown pooling {pooling}")
+
+    def get_xyz(self, u, v, depth):
+        """
+        Retrieve world points for pixels of the depth image returned by get_image
+
+        Args:
+            u: pixel column, scalar or array
+            v: pixel row, scalar or array of the same shape as u
+            depth: [h, w] depth image
+
+        Returns:
+            [3,] world point for scalar pixels, otherwise [3, ...] world points with the shape of u
+        """
+        u = np.asarray(u)
+        v = np.asarray(v)
+        # depth is read at the nearest pixel
+        d = depth[np.clip(np.rint(v).astype(int), 0, self.image_dim[1] - 1),
+                  np.clip(np.rint(u).astype(int), 0, self.image_dim[0] - 1)]
+        d = self.get_metric_depth(np.asarray(d).reshape(-1))
+
+        # deproject the subpixel position like get_rays, then map from the point cloud frame into world
+        K = self.get_depth_intrinsics()
+        x = (u.reshape(-1) - K[0, 2]) / K[0, 0]
+        y = (v.reshape(-1) - K[1, 2]) / K[1, 1]
+        pts = self.optical_axes[:, None] * np.vstack((x, y, np.ones_like(x))) * d
+        Twc = np.linalg.inv(self.get_view())
+        pos = Twc[0:3, 0:3] @ pts + Twc[0:3, 3:4]
+        return pos.reshape((3,) + u.shape)
+
+    def get_pointcloud(self, depth, roi=None, level=0, pooling=None):
+        """
+        Retrieve pointcloud from depth
+
+        Args:
+            depth: [h, w] depth image as returned by get_image
+            roi: optional (u_min, v_min, u_max, v_max) pixel window, only pixels inside it are deprojected
+            level: pyramid level, the cloud is built from depth decimated by 2^level
+            pooling: how depth is decimated, see decimate
+
+        Returns:
+            [3, n] point cloud in camera frame
+        """
+        stride = 2 ** level
+        w, h = self.image_dim[0] // stride, self.image_dim[1] // stride
+        depth = depth.reshape(self.image_dim[1], self.image_dim[0])
+        rays = self.get_rays(level)
+        if roi is None:
+            u_min, v_min, u_max, v_max = 0, 0, w, h
+        else:
+            # window of the level that covers roi
+            u_min, v_min = roi[0] // stride, roi[1] // stride
+            u_max, v_max = min(-(-roi[2] // stride), w), min(-(-roi[3] // stride), h)
+            rays = rays.reshape(3, h, w)[:, v_min:v_max, u_min:u_max].reshape(3, -1)
+        depth = depth[v_min * stride:v_max * stride, u_min * stride:u_max * stride]
+        if level > 0:
+            depth = self.decimate(depth, level, pooling)
+        return self.get_metric_depth(depth).reshape(-1) * rays
+
+    def get_pointcloud_pixels(self, depth, pixels):
+        """
+        Retrieve the pointcloud of a set of pixels from depth
+
+        Args:
+            depth: [h, w] depth image as returned by get_image
+            pixels: [n] flat indices v * w + u of the pixels to deproject
+
+        Returns:
+            [3, n] point cloud in camera frame
+        """
+        depth = depth.reshape(-1)[pixels]
+        return self.get_metric_depth(depth) * self.get_rays(0)[:, pixels]
+
+    def get_roi(self, center, radius):
+        """
+        Get the pixel window of the depth image that bounds a sphere given in the point cloud frame
+
+        Args:
+            center: [3,] center of the sphere in camera frame
+            radius: radius of the sphere in meters
+
+        Returns:
+            (u_min, v_min, u_max, v_max) pixel window with exclusive max, or None if the sphere
+            reaches closer than the near plane or does not overlap the image
+        """
+        x, y, d = self.optical_axes * center
+        if d - radius <= self.near:
+            return None
+
+        # x / d over the bounding box of the sphere is extremal at its corners
+        x_min = min((x - radius) / (d - radius), (x - radius) / (d + radius))
+        x_max = max((x + radius) / (d - radius), (x + radius) / (d + radius))
+        y_min = min((y - radius) / (d - radius), (y - radius) / (d + radius))
+        y_max = max((y + radius) / (d - radius), (y + radius) / (d + radius))
+
+        K = self.get_depth_intrinsics()
+        w, h = self.image_dim
+        u_min = max(int(np.floor(K[0, 0] * x_min + K[0, 2])), 0)
+        u_max = min(int(np.ceil(K[0, 0] * x_max + K[0, 2])) + 1, w)
+        v_min = max(int(np.floor(K[1, 1] * y_min + K[1, 2])), 0)
+        v_max = min(int(np.ceil(K[1, 1] * y_max + K[1, 2])) + 1, h)
+        if u_min >= u_max or v_min >= v_max:
+            return None
+        return u_min, v_min, u_max, v_max
+
 
 #####################################
 # PyBullet implementation of Camera #
 #####################################
 class PyBulletCamera(Camera):
+    # OpenGL cameras look down -z with y up
+    optical_axes = np.array([1.0, -1.0, -1.0])
 
-    def __init__(self, camera_eye, camera_look, renderer=p.ER_TINY_RENDERER, image_dim=(1280, 800), camera_up=[0, 0, 1]):
-        super().__init__(camera_eye, camera_look, image_dim)
+    def __init__(self, camera_eye, camera_look, renderer=p.ER_TINY_RENDERER, image_dim=(1280, 800), camera_up=[0, 0, 1],
+                 seg_link_index=False, metric_depth=False, dtype=np.float64):
+        super().__init__(camera_eye, camera_look, image_dim, metric_depth, dtype)
         self.renderer = renderer
+        # encode link indices in the segmentation buffer as well as object ids
+        self.seg_link_index = seg_link_index
+        self.set_projection(45.0, 0.1, 2.6)
+        self.set_pose(camera_eye, camera_look, camera_up)
+
+    def set_projection(self, fov, near, far):
+        """
+        Set the intrinsics of the camera, this invalidates everything cached on them
+
+        Args:
+            fov: vertical field of view in degrees
+            near: near plane distance in meters
+            far: far plane distance in meters
+        """
+        self.fov = fov
+        self.near = near
+        self.far = far
 
         # This is a column major order of the projection
         self.ogl_projection_matrix = p.computeProjectionMatrixFOV(
-            fov=45.0,
+            fov=self.fov,
             aspect=self.image_dim[0] / self.image_dim[1],
-            nearVal=0.1,
-            farVal=2.6,
+            nearVal=self.near,
+            farVal=self.far,
         )
+        self.projectionMatrix = np.asarray(self.ogl_projection_matrix).reshape([4, 4], order='F')
+        self.T = np.linalg.inv(self.projectionMatrix)
+        u, v = np.meshgrid(np.arange(start=0, stop=self.image_dim[0]), np.arange(start=0, stop=self.image_dim[1]))
+        self.u = ((2 * u - self.image_dim[0]) / self.image_dim[0]).reshape(-1).astype(self.dtype)
+        self.v = -((2 * v - self.image_dim[1]) / self.image_dim[1]).reshape(-1).astype(self.dtype)
+        self.ones = np.ones(self.image_dim[0] * self.image_dim[1], dtype=self.dtype)
+        self.rays = {}
+
+    def set_pose(self, camera_eye, camera_look, camera_up=[0, 0, 1]):
+        """
+        Set the pose of the camera, this invalidates everything cached on it
+
+        Args:
+            camera_eye: [3,] position of the camera in world
+            camera_look: [3,] point in world the camera looks at
+            camera_up: [3,] up direction of the camera in world
+        """
+        self.camera_eye = camera_eye
+        self.camera_look = camera_look
+        self.camera_up = camera_up
 
         # This is a column major order of the extrinsics
         self.ogl_view_matrix = p.computeViewMatrix(
             cameraEyePosition=self.camera_eye,
             cameraTargetPosition=self.camera_look,
             cameraUpVector=camera_up)
-
-        self.projectionMatrix = np.asarray(self.ogl_projection_matrix).reshape([4, 4], order='F')
         self.viewMatrix = np.asarray(self.ogl_view_matrix).reshape([4, 4], order='F')
-        # self.T = np.linalg.inv(self.projectionMatrix)
-        intrinsic = np.eye(4)
-        intrinsic[0:3, 0:3] = self.get_intrinsics()
-        intrinsic[3, 3] = 1
-        # self.T = np.linalg.inv(intrinsic)
-        self.T = np.linalg.inv(self.projectionMatrix)
-        # self.T = np.linalg.inv(np.matmul(self.projectionMatrix, self.viewMatrix))
-        u, v = np.meshgrid(np.arange(start=0, stop=self.image_dim[0]), np.arange(start=0, stop=self.image_dim[1]))
-        self.u = ((2 * u - self.image_dim[0]) / self.image_dim[0]).reshape(-1)
-        self.v = -((2 * v - self.image_dim[1]) / self.image_dim[1]).reshape(-1)
-        self.ones = np.ones(self.image_dim[0] * self.image_dim[1])
 
     def get_intrinsics(self):
         proj_4x4 = np.array(self.ogl_projection_matrix).reshape(4, 4)
@@ -111,7 +325,10 @@ class PyBulletCamera(Camera):
         Tcw = Tc1c2 @ Tc2w
         return Tcw
 
-    def get_image(self, include_seg=False):
+    def get_image(self, include_seg=False, rgb=True, depth=True):
+        flags = p.ER_SEGMENTATION_MASK_OBJECT_AND_LINKINDEX if self.seg_link_index else 0
+        if not include_seg:
+            flags |= p.ER_NO_SEGMENTATION_MASK
         width, height, rgbImg, depthImg, segImg = p.getCameraImage(
             width=self.image_dim[0],
             height=self.image_dim[1],
@@ -120,39 +337,92 @@ class PyBulletCamera(Camera):
             lightDirection= -(self.camera_look - self.camera_eye),
             #lightColor = (1.0, 0.0, 0.0)
             #lightAmbientCoeff=0.6,
-            #flags=p.ER_SEGMENTATION_MASK_OBJECT_AND_LINKINDEX,
+            flags=flags,
             renderer=self.renderer
         )
 
-        rgb_img = np.array(rgbImg)[:, :, :3]
-        rgb_edit = rgb_img[..., [2, 1, 0]].copy()
-        depth_img = np.array(depthImg)
+        # when PyBullet is built with numpy these are already arrays and no copy is made here
+        shape = (self.image_dim[1], self.image_dim[0])
+        rgba = np.asarray(rgbImg, dtype=np.uint8).reshape(shape + (4,))
         if (include_seg):
-            return rgb_img, depth_img, np.array(segImg)
-        return rgb_edit, depth_img
-
-    def segmented_pointcloud(self, cloud, classes, seg_img):
-        keep = []
-        for y in range(seg_img.shape[0]):
-            for x in range(seg_img.shape[1]):
-                if (seg_img[y][x] in classes):
-                    keep.append(y * seg_img.shape[1] + x)
-        print(len(keep))
-        return cloud[:, keep]
+            depth_img = np.asarray(depthImg, dtype=self.dtype).reshape(shape)
+            if self.metric_depth:
+                depth_img = self.buffer_to_metric(depth_img)
+            return rgba[:, :, :3], depth_img, np.asarray(segImg).reshape(shape)
+
+        # swap to BGR straight into the camera's buffer
+        rgb_img = None
+        if rgb:
+            rgb_img = self.get_buffer('rgb', shape + (3,), np.uint8)
+            np.copyto(rgb_img, rgba[..., 2::-1])
+
+        depth_img = None
+        if depth:
+            depth_img = np.asarray(depthImg).reshape(shape)
+            if self.metric_depth:
+                depth_img = self.buffer_to_metric(depth_img, out=self.get_buffer('depth', shape, self.dtype))
+            elif depth_img.dtype != self.dtype:
+                depth_img = self.get_buffer('depth', shape, self.dtype)
+                np.copyto(depth_img, np.asarray(depthImg).reshape(shape))
+        return rgb_img, depth_img
+
+    def get_seg_mask(self, classes, seg):
+        """
+        Get a mask of the pixels that belong to any of the given classes
+
+        Args:
+            classes: body ids, or (body id, link index) tuples if the camera encodes link indices
+            seg: [h, w] PyBullet segmentation buffer
+
+        Returns:
+            [h * w] boolean mask over the flattened image
+        """
+        seg = np.asarray(seg).reshape(-1)
+        bodies = [c for c in classes if np.isscalar(c)]
+        links = [c for c in classes if not np.isscalar(c)]
+
+        if not self.seg_link_index:
+            if len(links) > 0:
+                raise ValueError("link level classes need a camera created with seg_link_index=True")
+            return np.isin(seg, bodies)
+
+        # with ER_SEGMENTATION_MASK_OBJECT_AND_LINKINDEX pixels hold objectUniqueId + ((linkIndex + 1) << 24)
+        foreground = seg >= 0
+        mask = foreground & np.isin(seg & ((1 << 24) - 1), bodies)
+        if len(links) > 0:
+            encoded = [body + ((link + 1) << 24) for body, link in links]
+            mask |= foreground & np.isin(seg, encoded)
+        return mask
+
+    def segmented_pointcloud(self, cloud, classes, seg_img, depth=None):
+        """
+        Crop a point cloud to the pixels that belong to any of the given classes
+
+        Args:
+            cloud: [3, h * w] full frame point cloud, or None to only deproject the kept pixels of depth
+            classes: body ids, or (body id, link index) tuples if the camera encodes link indices
+            seg_img: [h, w] PyBullet segmentation buffer
+            depth: [h, w] depth buffer, only needed when cloud is None
+
+        Returns:
+            mask: [h * w] boolean mask over the flattened image
+            keep: [n] flat indices of the kept pixels
+            cloud: [3, n] cropped point cloud
+        """
+        mask = self.get_seg_mask(classes, seg_img)
+        keep = np.flatnonzero(mask)
+        if cloud is None:
+            cloud = self.get_metric_depth(depth.reshape(-1)[keep]) * self.get_rays()[:, keep]
+        else:
+            cloud = cloud[:, keep]
+        return mask, keep, cloud
 
     # return u v depth lists only for pixels that belong to one of our classes 
     def seg_img(self, classes, seg, depth):
-        seg_reshape = seg.reshape(-1)
-        depth_reshape = depth.reshape(-1)
-        mask = np.zeros(seg_reshape.shape, dtype=bool)
-
-        for c in classes:
-            mask = mask | (seg_reshape == c)
-
-        keep_pix = np.argwhere(mask)
-        u = self.u[keep_pix]
-        v = self.v[keep_pix]
-        depth = depth_reshape[keep_pix]
+        keep = np.flatnonzero(self.get_seg_mask(classes, seg))
+        u = self.u[keep]
+        v = self.v[keep]
+        depth = depth.reshape(-1)[keep]
         return u, v, depth, np.ones((len(u), 1))
 
     def get_pointcloud_seg(self, depth, u, v, ones):
@@ -161,7 +431,6 @@ class PyBulletCamera(Camera):
                                 v.squeeze(),
                                 depth_mod.squeeze(),
                                 ones.squeeze()))
-        print(img_coords.shape)
         cam_coords = self.T @ img_coords
         cam_coords = cam_coords[0:3, :] / cam_coords[3, :]
         return cam_coords
@@ -172,6 +441,25 @@ class PyBulletCamera(Camera):
         true_depth /= true_depth[1, :]
         return true_depth[0, :]
 
+    def buffer_to_metric(self, depth, out=None):
+        # invert z_ndc = (P22 * z + P23) / -z elementwise, the metric depth is -z
+        # python floats keep the dtype of depth and the operations run in place on out
+        out = np.multiply(depth, 2, out=out)
+        out += float(self.projectionMatrix[2, 2]) - 1
+        return np.divide(float(self.projectionMatrix[2, 3]), out, out=out)
+
+    def get_metric_depth(self, depth):
+        if self.metric_depth:
+            return depth
+        return self.buffer_to_metric(depth)
+
+    def compute_rays(self):
+        # pixels at unit depth in the OpenGL camera frame, which looks down -z
+        P = self.projectionMatrix
+        x = (self.u + float(P[0, 2])) / float(P[0, 0])
+        y = (self.v + float(P[1, 2])) / float(P[1, 1])
+        return np.vstack((x, y, -self.ones))
+
     def get_depth_buffer(self, true_depth):
         true_depth = np.vstack((true_depth.reshape(-1), self.ones))
         depth_mod = self.projectionMatrix[2:4, 2:4] @ true_depth
@@ -179,71 +467,235 @@ class PyBulletCamera(Camera):
         depth = (depth_mod[0, :] + 1) / 2
         return depth
 
-    def get_pointcloud(self, depth):
-        depth_mod = 2 * depth - 1
-        img_coords = np.vstack((self.u,
-                                self.v,
-                                depth_mod.reshape(-1),
-                                self.ones))
-        cam_coords = self.T @ img_coords
-        cam_coords = cam_coords[0:3, :] / cam_coords[3, :]
-        return cam_coords
-
-    def get_xyz(self, u, v, depth):
-        # This code querys the depth buffer returned from the simulated camera and gets the <x,y,z> 
-        # point of the AR tag in world space 
-        # Source: https://stackoverflow.com/questions/59128880/getting-world-coordinates-from-opengl-depth-buffer
-        # First we compose the projection and view matrix using OpenGL convention (note column major order)
-        projectionMatrix = np.asarray(self.ogl_projection_matrix).reshape([4, 4], order='F')
-        viewMatrix = np.asarray(self.ogl_view_matrix).reshape([4, 4], order='F')
-        # We now invert the transform that was used to bring points into the normalized image coordinates
-        # This maps us from normalized image coordinates back into world coordinates
-        T = np.linalg.inv(np.matmul(projectionMatrix, viewMatrix))
-        # The AR tag center in u,v pixel coordinates is converted into OpenGL normalized image coordinates 
-        x = (2 * u - self.image_dim[0]) / self.image_dim[0]
-        y = -(2 * v - self.image_dim[1]) / self.image_dim[1]
-        # Z, a depth buffer reading from 0->1 is mapped from -1 to 1
-        z = 2 * depth[v, u] - 1
-        pix = np.asarray([x, y, z, 1])
-        # Map points from normalized image coordinates into world
-        pos = np.matmul(T, pix)
-        # Divide by the w component of the homogenous vector to get cartesian vector
-        pos /= pos[3]
-        return pos[0:3]
-
 
 ############################################
 # Realsense D455 ROS Camera implementation #
 ############################################
 class RealsenseCamera(Camera):
-    def __init__(self, camera_eye, camera_look, image_dim=(1280, 800)):
-        super().__init__(camera_eye, camera_look, image_dim)
-        self.depth = Listener("/camera/depth/image_rect_raw", Image)
-        self.color = Listener("/camera/color/image_raw", Image)
-        self.params = Listener("/camera/color/camera_info", CameraInfo)
-        info = self.params.get()
-        self.intrisnics = np.array(info.K).reshape(3, 3)
-
-        # print(self.intrisnics)
+    """
+    Realsense D455 through the realsense2_camera ROS driver. Point clouds, get_xyz and get_view use the
+    OpenCV optical frame of the depth image (z forward, y down).
+
+    Args:
+        camera_eye, camera_look: unused, kept for the generic camera interface
+        image_dim: (w, h) replaced by the resolution in the depth CameraInfo
+        metric_depth: get_image returns depth in meters instead of raw sensor units
+        depth_scale: meters per unit of 16 bit depth images
+        dtype: floating point type of depth images, rays and point clouds
+        aligned_depth: use depth registered to the color camera, so depth and color pixels line up
+        extrinsics: homogenous transform from world to the optical frame Tcw, identity by default
+        color_info, depth_info: CameraInfo messages to use instead of listening to the driver, for
+            working with recorded messages, depth_info defaults to color_info
+    """
+
+    def __init__(self, camera_eye, camera_look, image_dim=(1280, 800), metric_depth=False, depth_scale=0.001,
+                 dtype=np.float64, aligned_depth=True, extrinsics=None, color_info=None, depth_info=None):
+        super().__init__(camera_eye, camera_look, image_dim, metric_depth, dtype)
+        self.depth_scale = depth_scale
+        self.aligned_depth = aligned_depth
+        self.extrinsics = np.eye(4) if extrinsics is None else extrinsics
+        # ray tables by depth resolution and intrinsics, self.rays points at the current one
+        self.ray_cache = {}
+
+        self.depth = None
+        self.color = None
+        if color_info is None:
+            self.color = Listener("/camera/color/image_raw", Image)
+            self.params = Listener("/camera/color/camera_info", CameraInfo)
+            color_info = self.params.get()
+            if aligned_depth:
+                self.depth = Listener("/camera/aligned_depth_to_color/image_raw", Image)
+                depth_info = color_info
+            else:
+                self.depth = Listener("/camera/depth/image_rect_raw", Image)
+                depth_info = Listener("/camera/depth/camera_info", CameraInfo).get()
+        elif depth_info is None:
+            depth_info = color_info
+
+        self.intrisnics = np.array(color_info.K).reshape(3, 3)
+        self.set_depth_info(depth_info)
+
+    def set_depth_info(self, info):
+        """
+        Set the intrinsics and resolution of the depth image, switching to the matching cached ray table
+
+        Args:
+            info: CameraInfo of the depth image
+        """
+        self.depth_intrinsics = np.array(info.K).reshape(3, 3)
+        self.image_dim = (info.width, info.height)
+        key = (info.width, info.height, tuple(info.K))
+        self.rays = self.ray_cache.setdefault(key, {})
 
     def get_intrinsics(self):
         """Return OpenCV style intrinsics 3x3"""
         return self.intrisnics
 
+    def get_depth_intrinsics(self):
+        return self.depth_intrinsics
+
     def get_extrinsics(self):
         """Get homogenous extrisnic transform from world to camera Tcw 4x4"""
-        return np.eye(4)
+        return self.extrinsics
 
-    def get_image(self):
-        """Return RGB image and depth image"""
-        color_img: Image = self.color.get()
-        depth_img: Image = self.depth.get()
+    def get_view(self):
+        """Get the transform from world to the optical frame that point clouds are expressed in"""
+        return self.extrinsics
 
-        color_np = ros_numpy.numpify(color_img)
-        depth_np = ros_numpy.numpify(depth_img)
+    def get_image(self, rgb=True, depth=True):
+        """Return RGB image and depth image"""
+        color_np = None
+        if rgb:
+            color_img: Image = self.color.get()
+            color_np = ros_numpy.numpify(color_img)
+
+        depth_np = None
+        if depth:
+            depth_np = self.depth_from_msg(self.depth.get())
         return color_np, depth_np
 
-    def get_xyz(self, u, v, depth):
-        """ Retrieve pointcloud point from depth and image pt """
+    def depth_from_msg(self, msg):
+        """
+        Convert a depth Image message to the depth image get_image returns
+
+        Args:
+            msg: 16UC1 image in sensor units or 32FC1 image in meters
+
+        Returns:
+            [h, w] depth image, metric if self.metric_depth is set
+        """
+        depth_np = ros_numpy.numpify(msg)
+        if self.metric_depth:
+            depth_np = self.raw_to_metric(depth_np, out=self.get_buffer('depth', depth_np.shape, self.dtype))
+        return depth_np
+
+    def raw_to_metric(self, depth, out=None):
+        # 16 bit images are in sensor units, floating point images are in meters with NaN for no reading
+        if np.issubdtype(depth.dtype, np.integer):
+            return np.multiply(depth, self.depth_scale, out=out, dtype=self.dtype)
+        if out is None:
+            out = depth.astype(self.dtype)
+        else:
+            np.copyto(out, depth)
+        out[np.isnan(out)] = 0
+        return out
+
+    def get_metric_depth(self, depth):
+        if self.metric_depth:
+            return depth
+        return self.raw_to_metric(depth)
 
-        return np.array([0, 0, 0])
+    def get_true_depth(self, depth):
+        # the optical frame looks down +z, so depth is the z coordinate
+        return self.get_metric_depth(depth).reshape(-1)
+
+    def compute_rays(self):
+        # pixels at unit depth in the OpenCV camera frame, which looks down +z
+        u, v = np.meshgrid(np.arange(self.image_dim[0]), np.arange(self.image_dim[1]))
+        K = self.depth_intrinsics
+        x = (u.reshape(-1) - K[0, 2]) / K[0, 0]
+        y = (v.reshape(-1) - K[1, 2]) / K[1, 1]
+        return np.vstack((x, y, np.ones_like(x))).astype(self.dtype)
+
+
+################################################
+# Background capture wrapper around any Camera #
+################################################
+class AsyncCamera:
+    """
+    Captures frames from a camera on a worker thread into a triple buffer, get_image returns the latest
+    completed frame instead of waiting on the capture. Everything else is forwarded to the wrapped camera.
+
+    Of the three slots one holds the latest completed frame, one the frame the consumer was last handed and
+    the worker always owns the third, so it captures continuously and never waits on the consumer. A frame
+    stays valid until the next get_image call. PyBullet holds the GIL while rendering, so in simulation only
+    work that releases the GIL (numpy, Open3D) overlaps with capture; on ROS cameras the wait on the topic is
+    hidden entirely. An exception raised by the wrapped camera stops the worker and is raised again by the
+    next get_image call.
+
+    Args:
+        camera: instance of a camera following generic camera interface
+        rgb: capture the color image
+        depth: capture the depth image
+    """
+
+    def __init__(self, camera: Camera, rgb=True, depth=True):
+        self.camera = camera
+        self.rgb = rgb
+        self.depth = depth
+
+        # three (rgb, depth, stamp) slots, front is the latest completed one and reading is held by the consumer
+        self.frames = [None, None, None]
+        self.front = None
+        self.reading = None
+        self.error = None
+        self.cond = threading.Condition()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.capture_loop, daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.camera, name)
+
+    def copy_into(self, buffer, image):
+        if image is None:
+            return None
+        if buffer is None or buffer.shape != image.shape or buffer.dtype != image.dtype:
+            return image.copy()
+        np.copyto(buffer, image)
+        return buffer
+
+    def get_back_slot(self):
+        # with three slots one is always neither the latest frame nor the one being read
+        return next(slot for slot in range(3) if slot != self.reading and slot != self.front)
+
+    def capture_loop(self):
+        try:
+            while self.running:
+                with self.cond:
+                    back = self.get_back_slot()
+                rgb, depth = self.camera.get_image(rgb=self.rgb, depth=self.depth)
+                stamp = time.time()
+
+                # the camera may reuse its buffers, so the frame is copied into the slot outside the lock, the
+                # consumer only ever takes front so the back slot stays the worker's until it is published
+                old = self.frames[back] or (None, None, None)
+                frame = (self.copy_into(old[0], rgb), self.copy_into(old[1], depth), stamp)
+
+                with self.cond:
+                    self.frames[back] = frame
+                    self.front = back
+                    self.cond.notify_all()
+        except Exception as e:
+            with self.cond:
+                self.error = e
+                self.running = False
+                self.cond.notify_all()
+
+    def get_image_stamped(self):
+        """
+        Return the latest completed frame, only blocks until the very first frame is captured
+
+        Returns:
+            rgb, depth, stamp: images (None if not captured) and the wall clock time they were captured at
+        """
+        with self.cond:
+            while self.front is None and self.error is None:
+                self.cond.wait()
+            if self.error is not None:
+                raise RuntimeError("background capture failed") from self.error
+            self.reading = self.front
+            return self.frames[self.reading]
+
+    def get_image(self, rgb=True, depth=True):
+        """Return the latest completed RGB image and depth image"""
+        rgb_img, depth_img, _ = self.get_image_stamped()
+        return (rgb_img if rgb else None), (depth_img if depth else None)
+
+    def stop(self):
+        """Stop the worker thread, must be called before the wrapped camera goes away"""
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
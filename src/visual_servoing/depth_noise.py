@@ -0,0 +1,103 @@
+import numpy as np
+
+
+class DepthNoiseModel:
+    """
+    Synthetic depth sensor noise for metric depth images. Each stage is vectorized and draws from banks of
+    random numbers generated once per trajectory, a frame only reads them at random offsets, so noisy
+    runs cost about the same as clean ones and are reproducible from the seed.
+
+    Args:
+        seed: seed of the np.random.Generator, the same seed gives the same noise sequence
+        edge_dropout: (min, max) fraction of depth discontinuity pixels zeroed each frame, None disables
+        edge_threshold: depth jump between neighbouring pixels in meters that counts as an edge
+        snp_fraction: (min, max) fraction of background pixels given salt and pepper depth each frame,
+            None disables background removal and salt and pepper noise
+        background_depth: pixels beyond this depth in meters, or without a reading, are background
+        snp_depth: mean depth of salt and pepper pixels in meters
+        snp_std: standard deviation of salt and pepper depth in meters
+        gaussian_std: standard deviation of the gaussian noise added to every pixel in meters, 0 disables
+        bank_size: number of samples in each noise bank, grown to the largest image seen
+        dtype: floating point type of the noise banks, should match the depth images
+    """
+
+    def __init__(self, seed=None, edge_dropout=(0.5, 1.0), edge_threshold=0.02, snp_fraction=(0.1, 0.2),
+                 background_depth=2.0, snp_depth=1.0, snp_std=0.1, gaussian_std=0.05, bank_size=2 ** 20,
+                 dtype=np.float32):
+        self.edge_dropout = edge_dropout
+        self.edge_threshold = edge_threshold
+        self.snp_fraction = snp_fraction
+        self.background_depth = background_depth
+        self.snp_depth = snp_depth
+        self.snp_std = snp_std
+        self.gaussian_std = gaussian_std
+        self.bank_size = bank_size
+        self.dtype = np.dtype(dtype)
+        self.reset(seed)
+
+    def reset(self, seed=None):
+        """
+        Restart the noise sequence, e.g. at the start of a trajectory
+
+        Args:
+            seed: seed of the np.random.Generator
+        """
+        self.rng = np.random.default_rng(seed)
+        self.uniform_bank = None
+        self.normal_bank = None
+
+    def build_banks(self, n):
+        # banks hold twice their size so any offset into the first half can read n samples without wrapping
+        self.bank_size = max(self.bank_size, n)
+        self.uniform_bank = self.rng.random(2 * self.bank_size, dtype=self.dtype)
+        self.normal_bank = self.rng.standard_normal(2 * self.bank_size, dtype=self.dtype)
+
+    def sample(self, bank, shape):
+        """ Read a block of noise of the given shape from a bank at a random offset """
+        n = int(np.prod(shape))
+        offset = self.rng.integers(self.bank_size)
+        return bank[offset:offset + n].reshape(shape)
+
+    def get_edges(self, depth):
+        """ Mask of pixels on either side of a depth jump larger than edge_threshold """
+        edges = np.zeros(depth.shape, dtype=bool)
+        jump_u = np.abs(np.diff(depth, axis=1)) > self.edge_threshold
+        jump_v = np.abs(np.diff(depth, axis=0)) > self.edge_threshold
+        edges[:, 1:] |= jump_u
+        edges[:, :-1] |= jump_u
+        edges[1:, :] |= jump_v
+        edges[:-1, :] |= jump_v
+        return edges
+
+    def apply(self, depth, roi=None):
+        """
+        Add noise to a metric depth image in place
+
+        Args:
+            depth: [h, w] metric depth image, zero meaning no reading
+            roi: optional (u_min, v_min, u_max, v_max) pixel window, noise is only added inside it
+
+        Returns:
+            depth: the same image with noise added
+        """
+        view = depth if roi is None else depth[roi[1]:roi[3], roi[0]:roi[2]]
+        if self.uniform_bank is None or view.size > self.bank_size:
+            self.build_banks(view.size)
+
+        # drop out part of the pixels on depth discontinuities, like stereo sensors do
+        if self.edge_dropout is not None:
+            edges = self.get_edges(view)
+            fraction = self.rng.uniform(*self.edge_dropout)
+            view[edges & (self.sample(self.uniform_bank, view.shape) < fraction)] = 0
+
+        # remove the background and scatter salt and pepper depth readings over it
+        if self.snp_fraction is not None:
+            background = (view > self.background_depth) | (view == 0)
+            fraction = self.rng.uniform(*self.snp_fraction)
+            snp = background & (self.sample(self.uniform_bank, view.shape) < fraction)
+            view[background] = 0
+            view[snp] = self.snp_depth + self.snp_std * self.sample(self.normal_bank, view.shape)[snp]
+
+        if self.gaussian_std > 0:
+            view += self.gaussian_std * self.sample(self.normal_bank, view.shape)
+        return depth
@@ -1,12 +1,16 @@
-import pickle as pkl
+import time
 
 import cv2
 import numpy as np
 import open3d as o3d
-import tensorflow as tf
 
+from visual_servoing import sdf
+from visual_servoing.assets import load_asset
 from visual_servoing.camera import Camera
 from visual_servoing.pbvs import PBVS
+from visual_servoing.prediction import MotionPredictor
+from visual_servoing.registration import ICPRegistration, MultiScaleICPRegistration, SDFRegistration, SDFScorer
+from visual_servoing.relocalization import GlobalRegistration, TrackingMonitor
 
 
 def SE3(se3):
@@ -44,30 +48,120 @@ class ICPPBVS(PBVS):
         max_joint_velo: maximum joint velocity 
         seg_range: segmentation range in meters
         debug: do debugging visualizations or not
+        vis: VisualizationService the segmented cloud and the model are published to, None shows nothing
+        use_roi: only deproject the pixels covered by the model at the predicted pose
+        min_seg_points: tracking is considered lost when fewer points than this are segmented
+        dtype: floating point type of the point clouds, defaults to the dtype of the camera
+        coarse_level: if nonzero, register a cloud decimated by 2^coarse_level before the full resolution one
+        pooling: how the depth image is decimated for the coarse cloud, None, 'min' or 'median'
+        seg_backend: 'numpy' (numba accelerated when installed) or 'tensorflow' for the SDF segmentation
+        icp_estimator: 'point_to_point', 'point_to_plane' or 'generalized' ICP
+        multiscale_icp: dict of per level voxel_sizes, max_distances and max_iterations for coarse to fine ICP,
+            None registers at a single scale
+        registration: 'icp' against the model points or 'sdf' to register directly against the model SDF
+        registration_budget: wall clock seconds per frame for segmentation and registration, registration returns
+            its latest pose once they are spent, None never stops early
+        plateau_iterations: stop registering after this many iterations changing the rmse by less than
+            plateau_rmse, 0 disables
+        plateau_rmse: smallest rmse change in meters that counts as registration progress
+        tracking_monitor: dict of min_fitness, max_rmse and min_point_ratio a registration must meet to be trusted,
+            together with min_seg_points, with the fitness and rmse scored against the model SDF within
+            inlier_distance whatever the registration engine. None only checks the point count
+        relocalization: dict of search_radius, level, voxel_size, max_iteration, confidence and attempts of the
+            global registration run when tracking is lost, None disables it
+        velocity_weight: weight of the constant velocity extrapolation of past estimates in the pose prediction,
+            0 only integrates the commanded twist
+        mask_refresh: track the segmented pixels across frames and only test the previous mask dilated by the
+            expected motion against the SDF, segmenting the whole window around the prediction every mask_refresh
+            frames, None segments the whole window every frame
     ​
     """
+    uses_rgb = False
 
     def __init__(self, camera: Camera, k_v: float, k_omega: float, max_joint_velo: float, start_eef_pose,
-                 seg_range=0.04, debug=True, vis=None):
+                 seg_range=0.04, debug=True, vis=None, use_roi=True, min_seg_points=50, dtype=None,
+                 coarse_level=0, pooling=None, seg_backend='numpy', icp_estimator='point_to_point',
+                 multiscale_icp=None, registration='icp', registration_budget=None, plateau_iterations=0,
+                 plateau_rmse=0.0, tracking_monitor=None, relocalization=None,
+                 velocity_weight=0.0, mask_refresh=None):
         super().__init__(camera, k_v, k_omega, max_joint_velo, debug)
         self.seg_range = seg_range
-
-        self.model_sdf = pkl.load(open("points_and_sdf.pkl", "rb"))
+        self.coarse_level = coarse_level
+        self.pooling = pooling
+        self.dtype = camera.dtype if dtype is None else np.dtype(dtype)
+        self.use_roi = use_roi
+        self.min_seg_points = min_seg_points
+        self.tracking_lost = False
+        if seg_backend not in ('numpy', 'tensorflow'):
+            raise ValueError(f"unknown segmentation backend {seg_backend}")
+        self.seg_backend = seg_backend
+        # flat indices of the pixels segmented in the previous frame, None until the next full segmentation
+        self.mask_refresh = mask_refresh
+        self.mask_pixels = None
+        self.mask_age = 0
+
+        self.model_sdf = load_asset("points_and_sdf.pkl")
         self.model = o3d.geometry.PointCloud()
         self.model_raw = np.array(self.model_sdf['points'])
         self.model.points = o3d.utility.Vector3dVector(self.model_raw)
         self.model.paint_uniform_color([0, 0.651, 0.929])
 
+        # the model never changes, so its KD-tree, normals and covariances or SDF gradient are built once here
+        iteration_settings = {"plateau_iterations": plateau_iterations, "plateau_rmse": plateau_rmse}
+        if registration == 'sdf':
+            self.registration = SDFRegistration(self.model_sdf['sdf'], self.model_sdf['origin_point'],
+                                                self.model_sdf['res'], **iteration_settings)
+        elif registration != 'icp':
+            raise ValueError(f"unknown registration engine {registration}")
+        elif multiscale_icp is None:
+            self.registration = ICPRegistration(self.model_raw, icp_estimator, **iteration_settings)
+        else:
+            self.registration = MultiScaleICPRegistration(self.model_raw, icp_estimator, **multiscale_icp,
+                                                          **iteration_settings)
+        self.registration_budget = registration_budget
+        self.last_registration = None
+        self.registration_stats = {"frames": 0, "budget_hits": 0, "converged": 0, "iterations": 0, "lost": 0,
+                                   "relocalizations": 0, "relocalized": 0, "coarse_budget_hits": 0,
+                                   "coarse_iterations": 0}
+
+        # local registration is checked every frame, the expensive global search only runs once it lost track.
+        # Every engine's pose is scored against the model SDF, so the bounds do not depend on the engine, the SDF
+        # engine scores itself and the others sample the shared model SDF
+        if tracking_monitor is None:
+            self.monitor = TrackingMonitor(0.0, np.inf, min_seg_points)
+        else:
+            scorer = self.registration if isinstance(self.registration, SDFRegistration) else SDFScorer(
+                self.model_sdf['sdf'], self.model_sdf['origin_point'], self.model_sdf['res'])
+            self.monitor = TrackingMonitor(tracking_monitor['min_fitness'], tracking_monitor['max_rmse'],
+                                           min_seg_points, tracking_monitor['min_point_ratio'], scorer=scorer,
+                                           inlier_distance=tracking_monitor['inlier_distance'])
+        self.global_registration = None
+        if relocalization is not None:
+            self.relocalization_radius = relocalization['search_radius']
+            self.relocalization_level = relocalization['level']
+            self.relocalization_attempts = relocalization['attempts']
+            self.global_registration = GlobalRegistration(self.model_raw, relocalization['voxel_size'],
+                                                          relocalization['max_iteration'],
+                                                          relocalization['confidence'])
+
+        # bounding sphere of the model in link frame, used to find the image region it covers
+        model_min = np.min(self.model_raw, axis=0)
+        model_max = np.max(self.model_raw, axis=0)
+        self.model_center = (model_min + model_max) / 2
+        self.model_radius = np.max(np.linalg.norm(self.model_raw - self.model_center, axis=1))
+
         self.prev_pose = start_eef_pose
         self.prev_twist = np.zeros(6)
+        self.predictor = MotionPredictor(velocity_weight)
+        self.predictor.reset(start_eef_pose)
         self.max_joint_velo = max_joint_velo
 
         self.pcl = o3d.geometry.PointCloud()
 
-        if(debug):
-            self.vis = vis
-            self.vis.add_geometry(self.pcl)
-            self.vis.add_geometry(self.model)
+        # the model cloud never changes, it is published to the visualization service once
+        self.vis = vis
+        if(debug and vis is not None):
+            vis.publish_cloud("model", self.model_raw, [0, 0.651, 0.929])
 
         self.pose_predict_uids = None
         self.prev_pose_predict_uids = None
@@ -76,59 +170,47 @@ class ICPPBVS(PBVS):
         self.cheat_pose = None
 
     def __del__(self):
-        if(self.debug):
-            self.vis.remove_geometry(self.pcl)
-            self.vis.remove_geometry(self.model)
         print('destroyed')
 
     def draw_registration_result(self):
-        # o3d.visualization.draw_geometries([self.pcl, self.model])
-        self.vis.update_geometry(self.pcl)
-        self.vis.update_geometry(self.model)
-        self.vis.poll_events()
-        self.vis.update_renderer()
-
-    def round_to_res(self, x, res):
-        # helps with stupid numerics issues
-        return tf.cast(tf.round(x / res), tf.int64)
+        # only publishes a snapshot, the visualization service prepares it on its own thread
+        self.vis.publish_cloud("segmented", self.pcl.points, [1, 0.706, 0])
 
-    def batch_point_to_idx(self, points, res, origin_point):
+    def segment_mask(self, pc, sdf_grid, origin_point, res, threshold):
         """
+        segment with the selected backend, both give the same mask
     ​
         Args:
-            points: [b,3] points in a frame, call it world
-            res: [b] meters
-            origin_point: [b,3] the position [x,y,z] of the center of the voxel (0,0,0) in the same frame as points
+            pc: [n, 3], as set of n (x,y,z) points in the same frame as the voxel grid
+            sdf_grid: [h, w, c], signed distance field
+            origin_point: [3], the (x,y,z) position of voxel [0,0,0]
+            res: scalar, size of one voxel in meters
+            threshold: the distance threshold determining what's segmented
     ​
         Returns:
+            [n] boolean mask of the segmented points
     ​
         """
-        return self.round_to_res((points - origin_point), tf.expand_dims(res, -1))
+        if self.seg_backend == 'numpy':
+            return sdf.segment_mask(pc, sdf_grid, origin_point, res, threshold)
+        return sdf.segment_mask_tf(pc, sdf_grid, origin_point, res, threshold)
 
-    def segment(self, pc, sdf, origin_point, res, threshold):
+    def segment_in_link_frame(self, pcl, pose):
         """
-    ​
+        find the points of a camera frame cloud that are close to the model at a pose
+
         Args:
-            pc: [n, 3], as set of n (x,y,z) points in the same frame as the voxel grid
-            sdf: [h, w, c], signed distance field
-            origin_point: [3], the (x,y,z) position of voxel [0,0,0]
-            res: scalar, size of one voxel in meters
-            threshold: the distance threshold determining what's segmented
+            pcl: [3, n] point cloud in camera frame, in self.dtype
+            pose: homogenous transform from camera to eef link
     ​
         Returns:
-            [m, 3] the segmented points
+            [n] boolean mask of the segmented points
     ​
         """
-        pc = tf.convert_to_tensor(pc, dtype=tf.float32)
-        indices = self.batch_point_to_idx(pc, res, origin_point)
-        in_bounds = tf.logical_not(
-            tf.logical_or(tf.reduce_any(indices <= 0, -1), tf.reduce_any(indices >= sdf.shape, -1)))
-        in_bounds_indices = tf.boolean_mask(indices, in_bounds, axis=0)
-        in_bounds_pc = tf.boolean_mask(pc, in_bounds, axis=0)
-        distances = tf.gather_nd(sdf, in_bounds_indices)
-        close = distances < threshold
-        segmented_points = tf.boolean_mask(in_bounds_pc, close, axis=0)
-        return segmented_points
+        Tlc = np.linalg.inv(pose).astype(self.dtype)
+        pcl_linkfrm = (Tlc[0:3, 0:3] @ pcl + Tlc[0:3, 3:4]).T
+        return self.segment_mask(pcl_linkfrm, self.model_sdf['sdf'], self.model_sdf['origin_point'],
+                                 self.model_sdf['res'], self.seg_range)
 
     # segment point cloud via radius around predicted pose in camera frame
     def radius_segment(self,pcl, pose_predict):
@@ -136,6 +218,166 @@ class ICPPBVS(PBVS):
         dist = np.sqrt(np.sum((pcl - c)**2, axis=0))
         return pcl[:, dist < self.seg_range]
 
+    def get_roi(self, pose_predict):
+        """
+        get the image window covered by the model at the predicted pose, None means the full frame
+
+        Args:
+            pose_predict: predicted homogenous transform from camera to eef link
+    ​
+        Returns:
+            (u_min, v_min, u_max, v_max) pixel window or None
+    ​
+        """
+        if not self.use_roi or self.tracking_lost:
+            return None
+        center = pose_predict @ np.hstack((self.model_center, 1))
+        return self.camera.get_roi(center[0:3], self.model_radius + self.seg_range)
+
+    def get_segmented_cloud(self, depth, pose_predict, level=0):
+        """
+        deproject the depth image around the predicted pose and keep the points close to the model
+
+        Args:
+            depth: [h, w], depth image to create point cloud with 
+            pose_predict: predicted homogenous transform from camera to eef link
+            level: pyramid level of the depth image to deproject
+    ​
+        Returns:
+            [3, n] segmented point cloud in camera frame
+    ​
+        """
+        # only deproject the part of the image the gripper can be in, unless tracking was lost
+        pcl_raw = self.camera.get_pointcloud(depth, self.get_roi(pose_predict), level, self.pooling)
+        pcl_raw = pcl_raw.astype(self.dtype, copy=False)
+        return pcl_raw[:, self.segment_in_link_frame(pcl_raw, pose_predict)]
+
+    def get_window_pixels(self, roi):
+        # flat indices of every pixel in the window, or the whole frame
+        w, h = self.camera.image_dim
+        u_min, v_min, u_max, v_max = (0, 0, w, h) if roi is None else roi
+        v, u = np.mgrid[v_min:v_max, u_min:u_max]
+        return (v * w + u).reshape(-1)
+
+    def get_mask_padding(self, pose_predict):
+        """
+        bound in pixels of how far the gripper silhouette moves between the previous estimate and the prediction
+
+        Args:
+            pose_predict: predicted homogenous transform from camera to eef link
+    ​
+        Returns:
+            dilation radius in pixels
+    ​
+        """
+        prev_pose = self.predictor.pose
+        center = np.hstack((self.model_center, 1))
+        center_predict = (pose_predict @ center)[0:3]
+        rvec, _ = cv2.Rodrigues(pose_predict[0:3, 0:3] @ prev_pose[0:3, 0:3].T)
+        # no model point moves further than the center plus the rotation swinging the bounding sphere, the
+        # segmentation range is the margin for the prediction error
+        motion = (np.linalg.norm(center_predict - (prev_pose @ center)[0:3]) + np.linalg.norm(rvec) *
+                  self.model_radius + self.seg_range)
+        # the nearest model point moves the most pixels
+        depth = max(abs(center_predict[2]) - self.model_radius, 0.1)
+        return int(np.ceil(self.camera.get_intrinsics()[0, 0] * motion / depth))
+
+    def dilate_mask(self, pixels, padding):
+        """
+        grow a set of pixels by padding in every direction, only the window around them is touched
+
+        Args:
+            pixels: [n] flat pixel indices
+            padding: dilation radius in pixels
+    ​
+        Returns:
+            [m] flat indices of the dilated pixels
+    ​
+        """
+        w, h = self.camera.image_dim
+        v, u = np.divmod(pixels, w)
+        u_min, v_min = max(np.min(u) - padding, 0), max(np.min(v) - padding, 0)
+        u_max, v_max = min(np.max(u) + padding + 1, w), min(np.max(v) + padding + 1, h)
+        mask = np.zeros((v_max - v_min, u_max - u_min), dtype=np.uint8)
+        mask[v - v_min, u - u_min] = 1
+        mask = cv2.dilate(mask, np.ones((2 * padding + 1, 2 * padding + 1), dtype=np.uint8))
+        v, u = np.nonzero(mask)
+        return (v + v_min) * w + (u + u_min)
+
+    def get_tracked_cloud(self, depth, pose_predict):
+        """
+        segment only the pixels of the previous mask dilated by the expected motion, the whole window around the
+        predicted pose is segmented every mask_refresh frames and whenever there is no mask to track
+
+        Args:
+            depth: [h, w], depth image to create point cloud with
+            pose_predict: predicted homogenous transform from camera to eef link
+    ​
+        Returns:
+            [3, n] segmented point cloud in camera frame
+    ​
+        """
+        if self.mask_pixels is None or len(self.mask_pixels) < self.min_seg_points or \
+                self.mask_age >= self.mask_refresh:
+            pixels = self.get_window_pixels(self.get_roi(pose_predict))
+            self.mask_age = 0
+        else:
+            pixels = self.dilate_mask(self.mask_pixels, self.get_mask_padding(pose_predict))
+            self.mask_age += 1
+        pcl_raw = self.camera.get_pointcloud_pixels(depth, pixels).astype(self.dtype, copy=False)
+
+        # same segmentation as get_segmented_cloud, but the mask is kept to know which pixels to track
+        mask = self.segment_in_link_frame(pcl_raw, pose_predict)
+        self.mask_pixels = pixels[mask]
+        return pcl_raw[:, mask]
+
+    def update_registration_stats(self, reg, coarse_reg=None):
+        # convergence diagnostics of the latest frame and how often the frame budget cut registration short, a
+        # frame hits the budget if either its coarse or its full resolution pass does
+        self.last_registration = reg
+        self.registration_stats["frames"] += 1
+        self.registration_stats["budget_hits"] += int(reg.budget_hit or (coarse_reg is not None and
+                                                                         coarse_reg.budget_hit))
+        self.registration_stats["converged"] += int(reg.converged)
+        self.registration_stats["iterations"] += reg.iterations
+        self.registration_stats["lost"] += int(self.tracking_lost)
+        if coarse_reg is not None:
+            self.registration_stats["coarse_budget_hits"] += int(coarse_reg.budget_hit)
+            self.registration_stats["coarse_iterations"] += coarse_reg.iterations
+
+    def relocalize(self, depth, pose_hint):
+        """
+        find the model again after tracking was lost, global registration on the scene around the last pose
+        followed by local registration on the cloud segmented at the pose it found. This ignores the frame budget,
+        it only runs on lost frames
+
+        Args:
+            depth: [h, w], depth image to create point cloud with 
+            pose_hint: homogenous transform from camera to eef link the model is searched around
+    ​
+        Returns:
+            RegistrationResult and [3, n] segmented cloud if the model was found, otherwise None
+    ​
+        """
+        self.registration_stats["relocalizations"] += 1
+        center = (pose_hint @ np.hstack((self.model_center, 1)))[0:3]
+        roi = self.camera.get_roi(center, self.relocalization_radius)
+        scene = self.camera.get_pointcloud(depth, roi, self.relocalization_level, self.pooling)
+        scene = scene[:, np.linalg.norm(scene - center[:, None], axis=0) < self.relocalization_radius]
+        if scene.shape[1] < self.min_seg_points:
+            return None
+
+        # RANSAC is randomized and the gripper is close to symmetric, so a few hypotheses are tried and the first
+        # one the monitor accepts after local refinement wins
+        for _ in range(self.relocalization_attempts):
+            global_reg = self.global_registration.register(scene.T)
+            pcl = self.get_segmented_cloud(depth, np.linalg.inv(global_reg.transformation))
+            reg = self.registration.register(pcl.T, 0.1, global_reg.transformation)
+            if self.monitor.is_tracking(reg, pcl.T):
+                self.registration_stats["relocalized"] += 1
+                return reg, pcl
+        return None
+
     def get_eef_state_estimate(self, depth, dt):
         """
         get eef state estimate relative to camera
@@ -148,53 +390,66 @@ class ICPPBVS(PBVS):
             Tcl: homogenous transform from camera to eef link
     ​
         """
-        pcl_raw = self.camera.get_pointcloud(depth)
-
-        # compute predicted pose using previous pose estimate, previously commanded twist and ellapsed time
-        action = self.prev_twist * dt
-        action_trans = np.hstack((action[0:3], 0))
-        action_rot = np.hstack((action[3:6], 0))
-        view = self.camera.get_view()
-        action_trans = view @ action_trans
-        action_rot = view @ action_rot
-        action_tf = SE3(np.hstack((action_trans[0:3], action_rot[0:3])))
-        pose_predict = self.prev_pose  # action_tf @ self.prev_pose#np.linalg.inv(action_tf) @ self.prev_pose #action_tf @ self.prev_pose
-        pose_predict[0:3, 3] = pose_predict[0:3, 3] + action_trans[0:3]
-        pose_predict[0:3, 0:3] = action_tf[0:3, 0:3] @ pose_predict[0:3, 0:3]
-
-        # transform point cloud into eef link frame using predicted pose
-        pcl_raw_linkfrm = np.linalg.inv(pose_predict) @ np.vstack((pcl_raw, np.ones((1, pcl_raw.shape[1]))))
-        pcl_raw_linkfrm = (pcl_raw_linkfrm.T)[:, 0:3]
-
-        # segment the point cloud and convert back to camera frame 
-        pcl_seg = self.segment(pcl_raw_linkfrm, self.model_sdf['sdf'], self.model_sdf['origin_point'],
-                               self.model_sdf['res'], self.seg_range)
-        pcl_raw = pose_predict @ np.hstack((pcl_seg, np.ones((pcl_seg.shape[0], 1)))).T
-        pcl_raw = pcl_raw[0:3, :]
-
-        # store the segmented point cloud from the camera as a class member for vis
-        self.pcl.points = o3d.utility.Vector3dVector(pcl_raw.T)
-        self.pcl.paint_uniform_color([1, 0.706, 0])
+        # segmentation and registration of this frame share the time budget
+        deadline = None if self.registration_budget is None else time.perf_counter() + self.registration_budget
+
+        # predict the pose from the previous estimate and the previously commanded twist over the ellapsed time
+        pose_predict = self.predictor.predict(self.camera.get_view(), self.prev_twist, dt)
+
+        # coarse registration on a decimated cloud refines the prediction before the full resolution pass
+        coarse_reg = None
+        if self.coarse_level > 0:
+            pcl_coarse = self.get_segmented_cloud(depth, pose_predict, self.coarse_level)
+            if pcl_coarse.shape[1] >= self.min_seg_points // 4 ** self.coarse_level:
+                coarse_reg = self.registration.register(pcl_coarse.T, 0.1, np.linalg.inv(pose_predict),
+                                                        deadline=deadline)
+                pose_predict = np.linalg.inv(coarse_reg.transformation)
+
+        if self.mask_refresh is None:
+            pcl_raw = self.get_segmented_cloud(depth, pose_predict)
+        else:
+            pcl_raw = self.get_tracked_cloud(depth, pose_predict)
 
         # run ICP: note we want Tcl, transform of eef link (l) in camera frame, but we do ICP with
         # segmented camera cloud as source and the model in link frame as target, so we estimate Tlc instead
-        reg = o3d.pipelines.registration.registration_icp(
-            self.pcl, self.model, 0.1, np.linalg.inv(pose_predict),
-            o3d.pipelines.registration.TransformationEstimationPointToPoint()
-        )
+        reg = self.registration.register(pcl_raw.T, 0.1, np.linalg.inv(pose_predict), deadline=deadline)
+
+        # a poor fit or too few points near the prediction means tracking is lost, try to find the model again
+        tracking = self.monitor.is_tracking(reg, pcl_raw.T)
+        if not tracking:
+            # the mask of a lost frame is not the gripper, segment the whole window again next frame
+            self.mask_pixels = None
+        relocalized = False
+        if not tracking and self.global_registration is not None:
+            relocalization = self.relocalize(depth, pose_predict)
+            if relocalization is not None:
+                reg, pcl_raw = relocalization
+                tracking = relocalized = True
+
+        # while lost the window around the prediction is likely wrong, search the full frame next time
+        self.tracking_lost = not tracking
+        self.update_registration_stats(reg, coarse_reg)
+
+        # store the segmented point cloud from the camera as a class member for vis, Vector3dVector copies
+        # contiguous float64 [n,3] arrays directly and falls back to a slow per point conversion otherwise
+        self.pcl.points = o3d.utility.Vector3dVector(np.ascontiguousarray(pcl_raw.T, dtype=np.float64))
+        self.pcl.paint_uniform_color([1, 0.706, 0])
         # for visualization purposes, PCL can be translated into link frame
         self.pcl.transform(reg.transformation)
 
-        # compute the thing we care about, the transform of the end effector in camera frame
-        Tcl = np.linalg.inv(reg.transformation)
+        # compute the thing we care about, the transform of the end effector in camera frame, an untrusted
+        # registration would poison the next prediction so the prediction is kept instead
+        Tcl = np.linalg.inv(reg.transformation) if tracking else pose_predict
 
         # visualize 
         # o3d.visualization.draw_geometries([self.pcl, self.model])
-        if (self.debug):
+        if (self.debug and self.vis is not None):
             self.draw_registration_result()
 
         # store eef pose in camera frame
         self.prev_pose = Tcl
+        # the jump from the lost prediction to a relocalized pose is not motion, so it does not count as velocity
+        self.predictor.update(Tcl, dt, tracking and not relocalized)
         return Tcl
 
     def do_pbvs(self, rgb, depth, Two, Tle, jac, jac_inv, dt):
@@ -33,14 +33,20 @@ class Marker:
         Create homogenous transform from marker to camera
 
         """
+        self.rvec = rvec
+        self.tvec = tvec
         Rcm, _ = cv2.Rodrigues(rvec)
         self.Tcm = np.vstack((np.hstack((Rcm, tvec)), np.array([0.0, 0, 0, 1])))
 
 
 class MarkerPBVS(PBVS):
+    uses_depth = False
 
     def __init__(self, camera : Camera, k_v : float, k_omega : float, max_joint_velo : float, 
-        start_eef_pose, eef_tag_ids, eef_tag_geometry, target_tag_ids, target_tag_geometry, use_pf=False, debug=True):
+        start_eef_pose, eef_tag_ids, eef_tag_geometry, target_tag_ids, target_tag_geometry, use_pf=False, debug=True,
+        track_roi=False, roi_padding=0.5, roi_min_padding=20, pyramid=False, min_marker_size=40, max_pyramid_level=3,
+        vis=None, klt_tracking=False, redetect_interval=10, klt_max_error=0.5, klt_padding=0.2,
+        klt_window=21, klt_levels=3):
         """
         Args:
             camera: instance of a camera following generic camera interface, must have OpenGL and OpenCV matricies defined
@@ -50,6 +56,26 @@ class MarkerPBVS(PBVS):
             eef_tag_ids: IDs of tags on a board, length of N for a board of N many tags
             eef_tag_geometry: (list of 4x3 numpy, each numpy mat is the 3d coordinates of the 4 tag corners, tl, tr, br, bl in that order in the eef_tag 
                 coordinate system the list is length N for a board of N many tags)
+            target_tag_ids: IDs of tags on the target board, None if there is no target board, more boards can be
+                registered with add_board
+            target_tag_geometry: tag corners of the target board like eef_tag_geometry
+            track_roi: detect the boards in a padded window around their previous detections, the full frame is
+                searched when there is no previous detection or a board is missed in the window
+            roi_padding: padding of the window as a fraction of the size of the previous detection
+            roi_min_padding: minimum padding of the window in pixels
+            pyramid: detect the boards on a downscaled frame and refine its corners on the full resolution one,
+                the level is the coarsest at which the smallest marker of the previous detection keeps
+                min_marker_size pixels on a side, capped at max_pyramid_level
+            vis: VisualizationService the annotated camera frame is published to, None draws and shows nothing
+            klt_tracking: between detections, propagate the corners of the boards found in the previous frame with
+                pyramidal Lucas-Kanade optical flow instead of detecting markers
+            redetect_interval: markers are detected at least every this many frames while tracking corners
+            klt_max_error: largest forward-backward flow error in pixels of a tracked corner, markers are detected
+                again if any corner exceeds it
+            klt_padding: the corners are tracked in the window of their previous positions padded by this times its
+                size, at least roi_min_padding pixels
+            klt_window: side of the Lucas-Kanade search window in pixels
+            klt_levels: number of pyramid levels of the optical flow above full resolution
 
         """
         super().__init__( camera, k_v, k_omega, max_joint_velo, debug)
@@ -61,11 +87,40 @@ class MarkerPBVS(PBVS):
         #self.aruco_params.adaptiveThreshWinSizeMin = 3
         #self.aruco_params.adaptiveThreshConstant = 10
 
-        # EEF board
-        self.eef_board = cv2.aruco.Board_create(eef_tag_geometry, self.aruco_dict, eef_tag_ids)
-        #self.target_board = cv2.aruco.Board_create(target_tag_geometry, self.aruco_dict, target_tag_ids)
+        # Boards by name, all of them are detected in one pass per frame
+        self.boards = {}
+        self.board_ids = {}
+        self.eef_board = self.add_board("eef", eef_tag_ids, eef_tag_geometry)
+        if target_tag_ids is not None:
+            self.target_board = self.add_board("target", target_tag_ids, target_tag_geometry)
         self.prev_pose = start_eef_pose
 
+        # board poses found by the latest detect_boards call, e.g. the one of do_pbvs
+        self.detection_poses = {}
+
+        # ROI tracking, board name to [n, 2] corners of its previous detection in pixels
+        self.track_roi = track_roi
+        self.roi_padding = roi_padding
+        self.roi_min_padding = roi_min_padding
+        self.board_corners = {}
+
+        # pyramid detection, the level is chosen from the size of the previous board detections
+        self.pyramid = pyramid
+        self.min_marker_size = min_marker_size
+        self.max_pyramid_level = max_pyramid_level
+        self.vis = vis
+
+        # KLT tracking, board name to the board markers of the previous frame, the window they are tracked in and
+        # its grayscale
+        self.klt_tracking = klt_tracking
+        self.redetect_interval = redetect_interval
+        self.klt_max_error = klt_max_error
+        self.klt_padding = klt_padding
+        self.klt_params = {"winSize": (klt_window, klt_window), "maxLevel": klt_levels,
+                           "criteria": (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 0.01)}
+        self.klt_boards = {}
+        self.frames_since_detection = 0
+
         # PF
         self.use_pf = use_pf
         self.prev_twist = np.zeros(6)
@@ -73,22 +128,44 @@ class MarkerPBVS(PBVS):
         self.pf = ParticleFilter()
         self.max_joint_velo = max_joint_velo
 
-    def detect_markers(self, frame, draw_debug=True):
+    def detect_markers(self, frame, draw_debug=True, roi=None, level=0):
         """
         Detect ARUCO tags in a given RGB frame and return a list of Marker objects
         ​
         Args:
             frame: rgb camera frame
+            roi: optional (u_min, v_min, u_max, v_max) pixel window to search, corners are still in frame pixels
+            level: pyramid level, markers are detected on the frame downscaled by 2^level and their corners are
+                refined on the full resolution frame
         ​
         Returns:
             out: python list of detected Marker objects
         ​
         """
         out = []
-        (corners_all, ids_all, rejected) = cv2.aruco.detectMarkers(frame, self.aruco_dict, parameters=self.aruco_params)
+        image = frame if roi is None else frame[roi[1]:roi[3], roi[0]:roi[2]]
+        if level > 0:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+            scale = 2 ** level
+            small = cv2.resize(gray, (gray.shape[1] // scale, gray.shape[0] // scale), interpolation=cv2.INTER_AREA)
+            (corners_all, ids_all, rejected) = cv2.aruco.detectMarkers(small, self.aruco_dict,
+                                                                       parameters=self.aruco_params)
+        else:
+            (corners_all, ids_all, rejected) = cv2.aruco.detectMarkers(image, self.aruco_dict,
+                                                                       parameters=self.aruco_params)
         if len(corners_all) == 0:
             return out
         ids = ids_all.flatten()
+        if level > 0:
+            # pixel centers of the downscaled image sit at the center of their 2^level block, then the corners
+            # are refined on the full resolution image within about one downscaled pixel
+            corners = np.concatenate(corners_all).reshape(-1, 1, 2) * scale + (scale - 1) / 2
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+            corners = cv2.cornerSubPix(gray, corners.astype(np.float32), (scale + 2, scale + 2), (-1, -1), criteria)
+            corners_all = list(corners.reshape(-1, 1, 4, 2))
+        if roi is not None:
+            corners_all = [marker_corner + np.array([roi[0], roi[1]], dtype=marker_corner.dtype)
+                           for marker_corner in corners_all]
 
         # Loop over the detected ArUco corners
         for (marker_corner, marker_id) in zip(corners_all, ids):
@@ -96,24 +173,187 @@ class MarkerPBVS(PBVS):
             marker_corner = marker_corner.reshape((4, 2))
             marker = Marker(marker_corner, marker_id)
 
-            # Convert the (x,y) coordinate pairs to integers
-            top_right = (int(marker.top_right[0]), int(marker.top_right[1]))
-            bottom_right = (int(marker.bottom_right[0]), int(marker.bottom_right[1]))
-            bottom_left = (int(marker.bottom_left[0]), int(marker.bottom_left[1]))
-            top_left = (int(marker.top_left[0]), int(marker.top_left[1]))
-
             # Draw the bounding box of the ArUco detection
             if draw_debug:
-                cv2.line(frame, top_left, top_right, (0, 255, 0), 2)
-                cv2.line(frame, top_right, bottom_right, (0, 255, 0), 2)
-                cv2.line(frame, bottom_right, bottom_left, (0, 255, 0), 2)
-                cv2.line(frame, bottom_left, top_left, (0, 255, 0), 2)
-                cv2.circle(frame, (marker.c_x, marker.c_y), 5, (255, 0, 0), -1)
+                self.draw_marker(frame, marker)
 
             out.append(marker)
 
         return out
 
+    def draw_marker(self, frame, marker):
+        # Convert the (x,y) coordinate pairs to integers
+        top_right = (int(marker.top_right[0]), int(marker.top_right[1]))
+        bottom_right = (int(marker.bottom_right[0]), int(marker.bottom_right[1]))
+        bottom_left = (int(marker.bottom_left[0]), int(marker.bottom_left[1]))
+        top_left = (int(marker.top_left[0]), int(marker.top_left[1]))
+
+        # Draw the bounding box of the ArUco detection
+        cv2.line(frame, top_left, top_right, (0, 255, 0), 2)
+        cv2.line(frame, top_right, bottom_right, (0, 255, 0), 2)
+        cv2.line(frame, bottom_right, bottom_left, (0, 255, 0), 2)
+        cv2.line(frame, bottom_left, top_left, (0, 255, 0), 2)
+        cv2.circle(frame, (marker.c_x, marker.c_y), 5, (255, 0, 0), -1)
+
+    def add_board(self, name, tag_ids, tag_geometry):
+        """
+        Register a marker board whose pose is estimated every frame, e.g. the eef, the target or a fixture
+
+        Args:
+            name: key of the board in the poses returned by detect_boards
+            tag_ids: IDs of tags on the board, length of N for a board of N many tags
+            tag_geometry: list of N 4x3 numpy, the tl, tr, br, bl tag corners in the board coordinate system
+        """
+        board = cv2.aruco.Board_create(tag_geometry, self.aruco_dict, tag_ids)
+        self.boards[name] = board
+        self.board_ids[name] = set(np.asarray(board.ids).flatten())
+        return board
+
+    def get_search_roi(self, frame):
+        """
+        Get the pixel window the boards are searched in, the previous detections padded by the expected motion
+
+        Args:
+            frame: rgb camera frame
+        ​
+        Returns:
+            (u_min, v_min, u_max, v_max) pixel window, or None to search the full frame
+        ​
+        """
+        if not self.track_roi or len(self.board_corners) == 0:
+            return None
+        return self.get_corner_window(frame, np.vstack(list(self.board_corners.values())), self.roi_padding)
+
+    def get_corner_window(self, frame, corners, padding_ratio):
+        # bounding box of a set of corners padded by padding_ratio times its size, at least roi_min_padding
+        corner_min = np.min(corners, axis=0)
+        corner_max = np.max(corners, axis=0)
+        padding = max(padding_ratio * np.max(corner_max - corner_min), self.roi_min_padding)
+        h, w = frame.shape[0:2]
+        u_min, v_min = np.maximum(np.floor(corner_min - padding).astype(int), 0)
+        u_max, v_max = np.minimum(np.ceil(corner_max + padding).astype(int) + 1, (w, h))
+        return u_min, v_min, u_max, v_max
+
+    def get_pyramid_level(self):
+        """
+        Get the pyramid level the boards are detected at, the coarsest one the smallest previously detected marker
+        still has min_marker_size pixels on a side at, 0 without a previous detection
+        """
+        if not self.pyramid or len(self.board_corners) == 0:
+            return 0
+        corners = np.vstack(list(self.board_corners.values())).reshape(-1, 4, 2)
+        sides = np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=-1)
+        level = int(np.floor(np.log2(max(np.min(sides), 1) / self.min_marker_size)))
+        return int(np.clip(level, 0, self.max_pyramid_level))
+
+    def get_board_poses(self, markers):
+        # partition one set of detected markers by board and estimate the pose of every board found
+        poses = {}
+        board_markers = {}
+        for name, board in self.boards.items():
+            board_markers[name] = [marker for marker in markers if marker.id in self.board_ids[name]]
+            ref_marker = self.get_board_pose(board_markers[name], board)
+            if ref_marker is not None:
+                poses[name] = ref_marker
+        return poses, board_markers
+
+    def detect_boards(self, frame):
+        """
+        Detect the markers of every registered board in a single pass and estimate all board poses. The search is
+        inside the tracked window and on the pyramid level of the previous detections if there are any, and in the
+        full resolution full frame if a board found in the previous frame is missed there. Boards that were not
+        found in the previous frame are picked up by the next full frame search. With klt_tracking the corners of
+        the previous frame are tracked instead between detections, see track_markers
+
+        Args:
+            frame: rgb camera frame
+        ​
+        Returns:
+            dict of board name to reference Marker of the board with its transform, for the boards found
+        ​
+        """
+        # corners are tracked between detections as long as every corner passes the forward-backward check and
+        # all boards of the previous frame are still found, the eef board has to be among them as servoing needs it
+        markers = None
+        if self.klt_tracking and "eef" in self.klt_boards \
+                and self.frames_since_detection + 1 < self.redetect_interval:
+            markers = self.track_markers(frame)
+            if markers is not None:
+                poses, board_markers = self.get_board_poses(markers)
+                if not self.board_corners.keys() <= poses.keys():
+                    markers = None
+
+        # nothing is drawn before the boards are found, lines on the frame would break the full frame search
+        if markers is None:
+            roi = self.get_search_roi(frame)
+            level = self.get_pyramid_level()
+            markers = self.detect_markers(frame, False, roi, level)
+            poses, board_markers = self.get_board_poses(markers)
+            if not self.board_corners.keys() <= poses.keys() and (roi is not None or level > 0):
+                markers = self.detect_markers(frame, False)
+                poses, board_markers = self.get_board_poses(markers)
+            self.frames_since_detection = 0
+        else:
+            self.frames_since_detection += 1
+        if self.klt_tracking:
+            self.update_klt(frame, poses, board_markers)
+
+        if self.debug and self.vis is not None:
+            for marker in markers:
+                self.draw_marker(frame, marker)
+            for ref_marker in poses.values():
+                cv2.aruco.drawAxis(frame, self.camera.get_intrinsics(), 0, ref_marker.rvec, ref_marker.tvec, 0.4)
+
+        # the next frame searches around the markers of the boards found in this one
+        self.board_corners = {name: np.vstack([marker.corners for marker in board_markers[name]])
+                              for name in poses}
+        self.detection_poses = poses
+        return poses
+
+    def track_markers(self, frame):
+        """
+        Propagate the board markers of the previous frame to this one with pyramidal Lucas-Kanade optical flow,
+        inside the window of each board. Every corner is tracked back to the previous frame and has to land within
+        klt_max_error pixels of where it started
+
+        Args:
+            frame: rgb camera frame
+        ​
+        Returns:
+            list of tracked Marker objects, or None if any corner failed
+        ​
+        """
+        tracked = []
+        for markers, (u_min, v_min, u_max, v_max), prev_gray in self.klt_boards.values():
+            gray = cv2.cvtColor(frame[v_min:v_max, u_min:u_max], cv2.COLOR_BGR2GRAY)
+            offset = np.array([u_min, v_min], dtype=np.float32)
+            prev_corners = (np.vstack([marker.corners for marker in markers]) - offset).astype(np.float32)
+            prev_corners = prev_corners.reshape(-1, 1, 2)
+            corners, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, prev_corners, None, **self.klt_params)
+            if corners is None or not np.all(status):
+                return None
+            back_corners, status, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, corners, None, **self.klt_params)
+            if back_corners is None or not np.all(status):
+                return None
+            if np.max(np.linalg.norm(back_corners - prev_corners, axis=-1)) > self.klt_max_error:
+                return None
+            # flow accumulates drift over frames, the corners are snapped back onto the image corners
+            corners = cv2.cornerSubPix(gray, corners, (3, 3), (-1, -1), self.klt_params["criteria"])
+            corners = corners.reshape(-1, 4, 2) + offset
+            tracked += [Marker(marker_corners, marker.id) for marker_corners, marker in zip(corners, markers)]
+        return tracked
+
+    def update_klt(self, frame, poses, board_markers):
+        # keep the grayscale window around each found board, the next frame tracks its markers inside it
+        self.klt_boards = {}
+        for name in poses:
+            markers = board_markers[name]
+            corners = np.vstack([marker.corners for marker in markers])
+            window = self.get_corner_window(frame, corners, self.klt_padding)
+            u_min, v_min, u_max, v_max = window
+            gray = cv2.cvtColor(frame[v_min:v_max, u_min:u_max], cv2.COLOR_BGR2GRAY)
+            self.klt_boards[name] = (markers, window, gray)
+
     def get_board_pose(self, markers, board, frame=None):
         """
         Estimate the pose of a predefined marker board given a set of candidate markers that may be in the board
@@ -155,31 +395,26 @@ class MarkerPBVS(PBVS):
         """
         cv2.imwrite(output, cv2.aruco.drawMarker(self.aruco_dict, id, 600))
 
-    def compute_board_to_world(self, ref_marker, depth):
+    def compute_board_to_world(self, ref_marker):
         """
         Get the transform from the world to the ar tag
 
         """
         Tcm = ref_marker.Tcm
-        # world -> camera -> ar tag
-        Twm = (np.linalg.inv(self.camera.get_extrinsics()) @ Tcm)
-        pos_unstable = (np.linalg.inv(self.camera.get_extrinsics()) @ Tcm)[0:3, 3]
-        # query point cloud at center of tag for the position of the tag in the world frame
-        pos = self.camera.get_xyz(ref_marker.c_x, ref_marker.c_y, depth)
-        Twm[0:3, 3] = pos_unstable #pos[0:3]
-        return Twm
+        # world -> camera -> ar tag, the position comes from the board pose estimate and not from depth
+        return np.linalg.inv(self.camera.get_extrinsics()) @ Tcm
 
     def do_pbvs(self, rgb, depth, Two, Tle, jac, jac_inv, dt):
-        # Find the EEF ar tag board
-        markers = self.detect_markers(rgb)
-        ref_marker = self.get_board_pose(markers, self.eef_board, rgb)
-        cv2.imshow("Camera", cv2.resize(rgb, (1280 // 3, 800 // 3)))  
+        # Find the EEF ar tag board, all boards are detected together
+        ref_marker = self.detect_boards(rgb).get("eef")
+        if self.debug and self.vis is not None:
+            self.vis.publish_image("Camera", rgb, (1280 // 3, 800 // 3))
 
         # If it was found, compute its pose estimate
         ctrl = np.zeros(6)
         Twe = self.prev_pose 
         if ref_marker is not None:
-            Twa_sensor = self.compute_board_to_world(ref_marker, depth)
+            Twa_sensor = self.compute_board_to_world(ref_marker)
             # compute transform from world to end effector by including rigid transform from
             # eef ar tag to end effector frame
             Twe = Twa_sensor @ Tle
@@ -194,13 +429,15 @@ class MarkerPBVS(PBVS):
 
         return ctrl, Twe
     
-    # Find pose of target board
-    def get_target_pose(self, rgb, depth, Tao, debug=True):
-        markers = self.detect_markers(rgb)
-        ref_marker = self.get_board_pose(markers, self.target_board, rgb)
+    # Find pose of target board. Pass poses=pbvs.detection_poses right after do_pbvs on the same frame to reuse
+    # its detections, cameras may hand out the same buffer every frame so that cannot be told from rgb
+    def get_target_pose(self, rgb, depth, Tao, debug=True, poses=None):
+        if poses is None:
+            poses = self.detect_boards(rgb)
+        ref_marker = poses.get("target")
 
         if ref_marker is not None:
-            Twa = self.compute_board_to_world(ref_marker, depth) 
+            Twa = self.compute_board_to_world(ref_marker) 
             return Twa @ Tao
         else:
             return None
\ No newline at end of file
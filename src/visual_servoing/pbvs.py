@@ -5,6 +5,10 @@ import cv2
 import pybullet
 
 class PBVS:
+    # which images do_pbvs reads, the loop skips capturing the others
+    uses_rgb = True
+    uses_depth = True
+
     def __init__(self, camera : Camera, k_v : float, k_omega : float, max_joint_velo : float, debug : bool=True):
         """
         Args:
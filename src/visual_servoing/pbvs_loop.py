@@ -20,6 +20,9 @@ class AbstractPBVSLoop:
         self.robot = robot
         self.side = side
         self.config = config
+        # only capture the images the PBVS method reads
+        self.capture_rgb = pbvs.uses_rgb
+        self.capture_depth = pbvs.uses_depth
 
     def run(self, target):
         self.on_before_run()
@@ -71,7 +74,7 @@ class AbstractPBVSLoop:
         pass
 
     def get_camera_image(self):
-        rgb, depth = self.camera.get_image()
+        rgb, depth = self.camera.get_image(rgb=self.capture_rgb, depth=self.capture_depth)
         return rgb, depth
 
     def get_pbvs_dt(self, current_t, last_t):
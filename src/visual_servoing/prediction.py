@@ -0,0 +1,161 @@
+import cv2
+import numpy as np
+
+
+def skew(v):
+    return np.array([
+        [0, -v[2], v[1]],
+        [v[2], 0, -v[0]],
+        [-v[1], v[0], 0]
+    ])
+
+
+def se3_exp(xi):
+    """
+    Exponential map of a twist
+
+    Args:
+        xi: [6,] twist [vx, vy, vz, omegax, omegay, omegaz], v is the velocity of the point at the frame origin
+
+    Returns:
+        4x4 homogenous transform of moving with the twist for unit time
+    """
+    v, omega = xi[0:3], xi[3:6]
+    theta = np.linalg.norm(omega)
+    W = skew(omega)
+    if theta < 1e-3:
+        # series of the coefficients below, which cancel catastrophically for small angles
+        V = np.eye(3) + (1 / 2 - theta ** 2 / 24) * W + (1 / 6 - theta ** 2 / 120) * W @ W
+    else:
+        V = np.eye(3) + (1 - np.cos(theta)) / theta ** 2 * W + (theta - np.sin(theta)) / theta ** 3 * W @ W
+    T = np.eye(4)
+    T[0:3, 0:3], _ = cv2.Rodrigues(omega.reshape(3, 1))
+    T[0:3, 3] = V @ v
+    return T
+
+
+def so3_log(R):
+    """
+    Logarithm map of a rotation matrix, accurate for tiny rotations and half turns where cv2.Rodrigues is not
+
+    Args:
+        R: 3x3 rotation matrix
+
+    Returns:
+        [3,] rotation vector, its norm is the angle in [0, pi]
+    """
+    w = np.array([R[2, 1] - R[1, 2], R[0, 2] - R[2, 0], R[1, 0] - R[0, 1]])
+    s = np.linalg.norm(w) / 2
+    c = (np.trace(R) - 1) / 2
+    theta = np.arctan2(s, c)
+    if c > 0:
+        # the antisymmetric part is 2 sin(theta) times the axis, theta / sin(theta) is well conditioned here
+        return w / 2 * (theta / s if s > 0 else 1.0)
+    # it vanishes towards a half turn, so the axis is read from the symmetric part (1 - cos(theta)) axis axis^T
+    B = (R + R.T) / 2 - c * np.eye(3)
+    k = np.argmax(np.diag(B))
+    axis = B[:, k] / np.sqrt(B[k, k] * (1 - c))
+    if axis @ w < 0:
+        axis = -axis
+    return theta * axis
+
+
+def se3_log(T):
+    """
+    Logarithm map of a homogenous transform, the inverse of se3_exp
+
+    Args:
+        T: 4x4 homogenous transform
+
+    Returns:
+        [6,] twist [vx, vy, vz, omegax, omegay, omegaz]
+    """
+    omega = so3_log(T[0:3, 0:3])
+    theta = np.linalg.norm(omega)
+    W = skew(omega)
+    if theta < 1e-3:
+        # series of the coefficient below, which cancels catastrophically for small angles
+        coefficient = 1 / 12 + theta ** 2 / 720
+    else:
+        coefficient = (1 - theta * np.sin(theta) / (2 * (1 - np.cos(theta)))) / theta ** 2
+    V_inv = np.eye(3) - W / 2 + coefficient * W @ W
+    return np.hstack((V_inv @ T[0:3, 3], omega))
+
+
+class MotionPredictor:
+    """
+    Predicts the pose of the end effector in camera frame for the next frame, the initial guess of registration.
+    The commanded twist, given in world frame for the eef link origin like PBVS.get_control returns it, is moved
+    to the camera frame and integrated over the frame period with the SE(3) exponential. It can be blended with
+    a constant velocity extrapolation of the last two trusted estimates, which also captures motion the robot
+    made but was not commanded, e.g. tracking lag or joint limits
+
+    Args:
+        velocity_weight: weight of the constant velocity extrapolation in the predicted twist, 0 only uses the
+            commanded twist and 1 only the estimated one
+    """
+
+    def __init__(self, velocity_weight=0.0):
+        self.velocity_weight = velocity_weight
+        self.pose = None
+        self.trusted = False
+        self.velocity = None
+
+    def reset(self, pose):
+        """
+        Start predicting from a known pose, forgetting the estimated velocity
+
+        Args:
+            pose: homogenous transform from camera to eef link
+        """
+        self.pose = pose.copy()
+        self.trusted = True
+        self.velocity = None
+
+    def get_camera_twist(self, Tcw, twist):
+        """
+        Args:
+            Tcw: homogenous transform from world to camera
+            twist: [6,] eef twist command in world frame, the velocity of the eef link origin and the angular velocity
+
+        Returns:
+            [6,] spatial twist in camera frame, its linear part is the velocity of the point at the camera origin
+        """
+        Rcw = Tcw[0:3, 0:3]
+        v = Rcw @ twist[0:3]
+        omega = Rcw @ twist[3:6]
+        # the twist rotates about the eef link origin, seen from the camera origin that adds p x omega
+        return np.hstack((v - np.cross(omega, self.pose[0:3, 3]), omega))
+
+    def predict(self, Tcw, twist, dt):
+        """
+        Predict the pose after moving with the commanded twist for dt, the stored pose is not changed
+
+        Args:
+            Tcw: homogenous transform from world to camera
+            twist: [6,] eef twist command in world frame [vx, vy, vz, omegax, omegay, omegaz]
+            dt: time the twist was executed for
+
+        Returns:
+            predicted homogenous transform from camera to eef link
+        """
+        xi = self.get_camera_twist(Tcw, twist)
+        if self.velocity is not None:
+            xi = (1 - self.velocity_weight) * xi + self.velocity_weight * self.velocity
+        return se3_exp(xi * dt) @ self.pose
+
+    def update(self, pose, dt, trusted=True):
+        """
+        Store the estimate of this frame, predictions start from it
+
+        Args:
+            pose: homogenous transform from camera to eef link
+            dt: time since the previous estimate
+            trusted: False if the pose is only a prediction, e.g. while tracking is lost, or was just relocalized,
+                it then does not count towards the estimated velocity and the previous estimate is kept
+        """
+        # velocity is only estimated between two trusted poses, a relocalization jump is not motion
+        if trusted and self.trusted and dt > 0:
+            self.velocity = se3_log(pose @ np.linalg.inv(self.pose)) / dt
+        self.pose = pose.copy()
+        self.trusted = trusted
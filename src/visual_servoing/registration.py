@@ -0,0 +1,511 @@
+import itertools
+import time
+
+import cv2
+import numpy as np
+import open3d as o3d
+from scipy.spatial import cKDTree
+
+
+def transform_points(T, points):
+    """ Apply a homogenous transform to [n, 3] points """
+    return points @ T[0:3, 0:3].T + T[0:3, 3]
+
+
+def twist_to_matrix(x):
+    """ Homogenous transform of a small [omegax, omegay, omegaz, vx, vy, vz] update """
+    T = np.eye(4)
+    T[0:3, 0:3], _ = cv2.Rodrigues(x[0:3])
+    T[0:3, 3] = x[3:6]
+    return T
+
+
+def local_covariances(tree, knn):
+    """
+    Covariances of the k nearest neighbours of every point in a KD-tree
+
+    Args:
+        tree: cKDTree over [n, 3] points
+        knn: number of neighbours
+
+    Returns:
+        [n, 3, 3] covariance matrices
+    """
+    points = tree.data
+    knn = min(knn, len(points))
+    _, idx = tree.query(points, k=knn)
+    neighbors = points[idx.reshape(len(points), knn)]
+    centered = neighbors - neighbors.mean(axis=1, keepdims=True)
+    return np.einsum('nki,nkj->nij', centered, centered) / knn
+
+
+def plane_covariances(covariances, epsilon):
+    """
+    Regularize covariances to planes as in generalized ICP, also returns the plane normals
+
+    Args:
+        covariances: [n, 3, 3] local covariance matrices
+        epsilon: variance along the normal relative to the in plane variance
+
+    Returns:
+        [n, 3, 3] regularized covariances, [n, 3] unit normals
+    """
+    # eigh sorts the eigenvalues ascending so the first eigenvector is the normal
+    _, U = np.linalg.eigh(covariances)
+    scale = np.array([epsilon, 1.0, 1.0])
+    return np.einsum('nij,j,nkj->nik', U, scale, U), U[:, :, 0]
+
+
+CUBE_CORNERS = np.array(list(itertools.product((0, 1), repeat=3)))
+
+
+def trilinear_interpolate(grid, origin_point, res, points):
+    """
+    Trilinear interpolation of a voxel grid
+
+    Args:
+        grid: [h, w, c] or [h, w, c, k] voxel grid, e.g. a SDF or a SDF with its gradient interleaved
+        origin_point: [3] the (x,y,z) position of voxel [0,0,0]
+        res: size of one voxel in meters
+        points: [n, 3] points in the frame of the grid
+
+    Returns:
+        [n] mask of the points inside the grid, [m] or [m, k] interpolated values of those points
+    """
+    grid_points = (points - origin_point) / res
+    base = np.floor(grid_points).astype(np.int64)
+    in_bounds = np.all((base >= 0) & (base < np.array(grid.shape[:3]) - 1), axis=1)
+    base = base[in_bounds]
+    frac = grid_points[in_bounds] - base
+    corners = base[:, None, :] + CUBE_CORNERS
+    values = grid[corners[..., 0], corners[..., 1], corners[..., 2]]
+    weights = np.where(CUBE_CORNERS, frac[:, None, :], 1 - frac[:, None, :]).prod(axis=2)
+    return in_bounds, np.einsum('mk,mk...->m...', weights, values)
+
+
+def voxel_downsample(points, voxel_size):
+    """
+    Replace the points in each voxel by their centroid
+
+    Args:
+        points: [n, 3] points
+        voxel_size: edge length of the voxels in meters, 0 keeps the points as they are
+
+    Returns:
+        [m, 3] downsampled points
+    """
+    if voxel_size <= 0 or len(points) == 0:
+        return points
+    keys = np.floor(points / voxel_size).astype(np.int64)
+    keys -= keys.min(axis=0)
+    _, inverse, counts = np.unique(np.ravel_multi_index(keys.T, keys.max(axis=0) + 1), return_inverse=True,
+                                   return_counts=True)
+    inverse = inverse.ravel()
+    centroids = np.empty((len(counts), 3))
+    for k in range(3):
+        centroids[:, k] = np.bincount(inverse, weights=points[:, k], minlength=len(counts)) / counts
+    return centroids
+
+
+def estimate_point_to_plane(source, target, normals):
+    """ Gauss-Newton step minimizing the distances of the source points to the target tangent planes """
+    r = np.sum((source - target) * normals, axis=1)
+    J = np.hstack((np.cross(source, normals), normals))
+    return twist_to_matrix(np.linalg.lstsq(J, -r, rcond=None)[0])
+
+
+class RegistrationResult:
+    """
+    Args:
+        transformation: homogenous transform taking the source onto the target
+        fitness: fraction of source points with a correspondence
+        inlier_rmse: root mean square distance of the correspondences
+        iterations: number of iterations run
+        converged: stopped because the fitness and rmse stopped changing or plateaued
+        budget_hit: stopped because the deadline passed
+        elapsed: wall clock time of the registration in seconds
+    """
+
+    def __init__(self, transformation, fitness, inlier_rmse, iterations=0, converged=False, budget_hit=False,
+                 elapsed=0.0):
+        self.transformation = transformation
+        self.fitness = fitness
+        self.inlier_rmse = inlier_rmse
+        self.iterations = iterations
+        self.converged = converged
+        self.budget_hit = budget_hit
+        self.elapsed = elapsed
+
+    def get_diagnostics(self):
+        return {
+            "fitness": self.fitness,
+            "inlier_rmse": self.inlier_rmse,
+            "iterations": self.iterations,
+            "converged": self.converged,
+            "budget_hit": self.budget_hit,
+            "elapsed": self.elapsed,
+        }
+
+
+class IterativeRegistration:
+    """
+    Iteration loop shared by the registration engines, subclasses provide evaluate and step. Stops when the
+    fitness and rmse stop changing, when the rmse plateaus, or when the deadline passes. A step can make the
+    pose worse, so the best pose seen, by fitness and then rmse, is returned rather than the latest one
+
+    Args:
+        max_iteration: maximum number of iterations
+        relative_fitness: stop when the fitness changes less than this between iterations
+        relative_rmse: stop when the rmse changes less than this between iterations
+        plateau_iterations: stop after this many consecutive iterations changing the rmse by less than
+            plateau_rmse, 0 disables
+        plateau_rmse: smallest rmse change in meters that counts as progress
+    """
+    min_correspondences = 3
+
+    def __init__(self, max_iteration=30, relative_fitness=1e-6, relative_rmse=1e-6, plateau_iterations=0,
+                 plateau_rmse=0.0):
+        self.max_iteration = max_iteration
+        self.relative_fitness = relative_fitness
+        self.relative_rmse = relative_rmse
+        self.plateau_iterations = plateau_iterations
+        self.plateau_rmse = plateau_rmse
+
+    def prepare(self, source):
+        """ per registration data of the source needed by step """
+        return None
+
+    def evaluate(self, points, max_distance):
+        """ fitness, rmse and correspondences of source points already in the model frame """
+        raise NotImplementedError()
+
+    def step(self, points, correspondences, data, T):
+        """ one update of the transform from the correspondences """
+        raise NotImplementedError()
+
+    def register(self, source, max_distance, init=None, max_iteration=None, deadline=None):
+        """
+        Register a point cloud to the model
+
+        Args:
+            source: [n, 3] points to register
+            max_distance: maximum correspondence distance in meters
+            init: initial guess of the transform from source to model frame
+            max_iteration: overrides the iteration cap of this registration
+            deadline: time.perf_counter() time to return by with the best pose so far, None runs to convergence
+
+        Returns:
+            RegistrationResult taking the source onto the model
+        """
+        start = time.perf_counter()
+        source = np.asarray(source, dtype=np.float64)
+        T = np.eye(4) if init is None else np.array(init, dtype=np.float64)
+        max_iteration = self.max_iteration if max_iteration is None else max_iteration
+
+        data = self.prepare(source)
+        current = transform_points(T, source)
+        fitness, rmse, correspondences = self.evaluate(current, max_distance)
+        best = (T, fitness, rmse)
+        iteration = 0
+        stalled = 0
+        converged = False
+        budget_hit = False
+        while iteration < max_iteration and len(correspondences[0]) >= self.min_correspondences:
+            if deadline is not None and time.perf_counter() >= deadline:
+                budget_hit = True
+                break
+            T = self.step(current, correspondences, data, T) @ T
+            current = transform_points(T, source)
+            prev_fitness, prev_rmse = fitness, rmse
+            fitness, rmse, correspondences = self.evaluate(current, max_distance)
+            iteration += 1
+            if (fitness, -rmse) > (best[1], -best[2]):
+                best = (T, fitness, rmse)
+
+            if abs(prev_fitness - fitness) < self.relative_fitness and abs(prev_rmse - rmse) < self.relative_rmse:
+                converged = True
+                break
+            stalled = stalled + 1 if abs(prev_rmse - rmse) < self.plateau_rmse else 0
+            if self.plateau_iterations and stalled >= self.plateau_iterations:
+                converged = True
+                break
+        T, fitness, rmse = best
+        return RegistrationResult(T, fitness, rmse, iteration, converged, budget_hit, time.perf_counter() - start)
+
+
+class ICPRegistration(IterativeRegistration):
+    """
+    ICP against a static model. Point to plane ICP runs here in numpy against a model KD-tree and normals that
+    are built once and reused for every registration. Point to point and generalized ICP run in Open3D's C++
+    ICP, faster per iteration than a numpy loop even though it builds its KD-tree of the model on every call,
+    against a model cloud, and for generalized ICP model covariances, that are built once
+
+    Args:
+        model: [n, 3] model points, the registration target
+        estimator: 'point_to_point', 'point_to_plane' or 'generalized'
+        knn: number of neighbours used to estimate normals and covariances
+        epsilon: normal variance of the generalized ICP plane covariances
+        open3d_iterations: with a deadline or plateau, Open3D runs this many iterations per call and they are
+            checked between calls, otherwise it runs all iterations in one call. The best pose is kept across calls
+        **kwargs: iteration settings of IterativeRegistration
+    """
+    estimators = ('point_to_point', 'point_to_plane', 'generalized')
+
+    def __init__(self, model, estimator='point_to_point', knn=20, epsilon=1e-3, open3d_iterations=5, **kwargs):
+        super().__init__(**kwargs)
+        if estimator not in self.estimators:
+            raise ValueError(f"unknown ICP estimator {estimator}")
+        self.estimator = estimator
+        self.knn = knn
+        self.epsilon = epsilon
+        self.open3d_iterations = open3d_iterations
+
+        self.model = np.asarray(model, dtype=np.float64)
+        if estimator == 'point_to_plane':
+            self.model_tree = cKDTree(self.model)
+            _, self.model_normals = plane_covariances(local_covariances(self.model_tree, knn), epsilon)
+        else:
+            self.model_cloud = self.to_open3d(self.model)
+
+    def to_open3d(self, points):
+        cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+        if self.estimator == 'generalized':
+            # Open3D uses covariances already set as they are, so they are regularized to planes here
+            covariances, _ = plane_covariances(local_covariances(cKDTree(points), self.knn), self.epsilon)
+            cloud.covariances = o3d.utility.Matrix3dVector(covariances)
+        return cloud
+
+    def register(self, source, max_distance, init=None, max_iteration=None, deadline=None):
+        if self.estimator == 'point_to_plane':
+            return super().register(source, max_distance, init, max_iteration, deadline)
+        return self.register_open3d(source, max_distance, init, max_iteration, deadline)
+
+    def register_open3d(self, source, max_distance, init=None, max_iteration=None, deadline=None):
+        """ register with Open3D ICP in calls of open3d_iterations iterations, same arguments as register """
+        start = time.perf_counter()
+        T = np.eye(4) if init is None else np.array(init, dtype=np.float64)
+        max_iteration = self.max_iteration if max_iteration is None else max_iteration
+        registration = o3d.pipelines.registration
+        if self.estimator == 'point_to_point':
+            estimation = registration.TransformationEstimationPointToPoint()
+        else:
+            estimation = registration.TransformationEstimationForGeneralizedICP(self.epsilon)
+
+        source = np.ascontiguousarray(source, dtype=np.float64)
+        if len(source) < self.min_correspondences:
+            return RegistrationResult(T, 0.0, 0.0, 0, False, False, time.perf_counter() - start)
+        source_cloud = self.to_open3d(source)
+        # every Open3D call builds a model KD-tree, so the iterations only run in several calls when a deadline or
+        # plateau has to be checked between them
+        chunk = max_iteration if deadline is None and not self.plateau_iterations else self.open3d_iterations
+        best = None
+        iteration = 0
+        stalled = 0
+        converged = False
+        budget_hit = False
+        while iteration < max_iteration:
+            if deadline is not None and time.perf_counter() >= deadline:
+                budget_hit = True
+                break
+            iterations = min(chunk, max_iteration - iteration)
+            criteria = registration.ICPConvergenceCriteria(self.relative_fitness, self.relative_rmse, iterations)
+            if self.estimator == 'point_to_point':
+                result = registration.registration_icp(source_cloud, self.model_cloud, max_distance, T, estimation,
+                                                       criteria)
+            else:
+                result = registration.registration_generalized_icp(source_cloud, self.model_cloud, max_distance, T,
+                                                                   estimation, criteria)
+            T = result.transformation
+            # Open3D does not report how many iterations it ran, so the iterations allowed are counted
+            iteration += iterations
+            if best is None:
+                best = (T, result.fitness, result.inlier_rmse)
+                continue
+            prev_fitness, prev_rmse = best[1], best[2]
+            if (result.fitness, -result.inlier_rmse) > (best[1], -best[2]):
+                best = (T, result.fitness, result.inlier_rmse)
+
+            # Open3D stops early once converged, which leaves the pose unchanged by the next call
+            if abs(prev_fitness - result.fitness) < self.relative_fitness and \
+                    abs(prev_rmse - result.inlier_rmse) < self.relative_rmse:
+                converged = True
+                break
+            stalled = stalled + iterations if abs(prev_rmse - result.inlier_rmse) < self.plateau_rmse * iterations \
+                else 0
+            if self.plateau_iterations and stalled >= self.plateau_iterations:
+                converged = True
+                break
+        if best is None:
+            evaluation = registration.evaluate_registration(source_cloud, self.model_cloud, max_distance, T)
+            best = (T, evaluation.fitness, evaluation.inlier_rmse)
+        T, fitness, rmse = best
+        return RegistrationResult(T, fitness, rmse, iteration, converged, budget_hit, time.perf_counter() - start)
+
+    def get_correspondences(self, points, max_distance):
+        """
+        Args:
+            points: [n, 3] source points in the model frame
+            max_distance: maximum correspondence distance in meters
+
+        Returns:
+            source indices, model indices, and distances of the correspondences
+        """
+        dist, idx = self.model_tree.query(points, distance_upper_bound=max_distance)
+        source_idx = np.flatnonzero(dist < max_distance)
+        return source_idx, idx[source_idx], dist[source_idx]
+
+    def evaluate(self, points, max_distance):
+        source_idx, model_idx, dist = self.get_correspondences(points, max_distance)
+        fitness = len(source_idx) / max(len(points), 1)
+        rmse = np.sqrt(np.mean(dist ** 2)) if len(dist) else 0.0
+        return fitness, rmse, (source_idx, model_idx)
+
+    def step(self, points, correspondences, data, T):
+        source_idx, model_idx = correspondences
+        return estimate_point_to_plane(points[source_idx], self.model[model_idx], self.model_normals[model_idx])
+
+
+class MultiScaleICPRegistration:
+    """
+    Coarse to fine ICP on voxel pyramids, the model pyramid and its KD-trees are built once and the source
+    pyramid once per registration, so most iterations run on a few hundred points with a wide correspondence
+    distance and only the last ones on the full clouds
+
+    Args:
+        model: [n, 3] model points, the registration target
+        estimator: 'point_to_point', 'point_to_plane' or 'generalized', see ICPRegistration
+        voxel_sizes: voxel size of each level in meters, coarse to fine, 0 uses the full resolution clouds
+        max_distances: maximum correspondence distance of each level in meters
+        max_iterations: iteration cap of each level
+        **kwargs: other iteration settings of IterativeRegistration, shared by the levels
+    """
+
+    def __init__(self, model, estimator='point_to_point', voxel_sizes=(0.016, 0.008, 0),
+                 max_distances=(0.1, 0.03, 0.01), max_iterations=(15, 10, 10), **kwargs):
+        if not len(voxel_sizes) == len(max_distances) == len(max_iterations):
+            raise ValueError("every ICP level needs a voxel size, max distance and iteration cap")
+        model = np.asarray(model, dtype=np.float64)
+        self.voxel_sizes = voxel_sizes
+        self.max_distances = max_distances
+        self.levels = [ICPRegistration(voxel_downsample(model, voxel_size), estimator, max_iteration=max_iteration,
+                                       **kwargs)
+                       for voxel_size, max_iteration in zip(voxel_sizes, max_iterations)]
+
+    def register(self, source, max_distance=None, init=None, max_iteration=None, deadline=None):
+        """
+        Register a point cloud to the model level by level
+
+        Args:
+            source: [n, 3] points to register
+            max_distance: optional upper bound on the correspondence distance of every level
+            init: initial guess of the transform from source to model frame
+            max_iteration: optional upper bound on the iteration cap of every level
+            deadline: time.perf_counter() time shared by the levels, finer levels are skipped once it passes
+
+        Returns:
+            RegistrationResult of the last level run, iterations and time summed over the levels
+        """
+        start = time.perf_counter()
+        source = np.asarray(source, dtype=np.float64)
+        T = np.eye(4) if init is None else init
+        iterations = 0
+        for level, voxel_size, level_distance in zip(self.levels, self.voxel_sizes, self.max_distances):
+            if max_distance is not None:
+                level_distance = min(level_distance, max_distance)
+            level_iteration = level.max_iteration if max_iteration is None else min(level.max_iteration,
+                                                                                    max_iteration)
+            result = level.register(voxel_downsample(source, voxel_size), level_distance, T, level_iteration,
+                                    deadline)
+            T = result.transformation
+            iterations += result.iterations
+            if result.budget_hit:
+                break
+        result.iterations = iterations
+        result.elapsed = time.perf_counter() - start
+        return result
+
+
+class SDFRegistration(IterativeRegistration):
+    """
+    Registers a point cloud directly against the model signed distance field, minimizing the sum of squared
+    SDF values of the points over the pose with Gauss-Newton. The SDF and its gradient are interleaved in one
+    grid built once, so each iteration is a single trilinear gather and no nearest neighbour search is needed.
+    Points with a larger absolute SDF value than the max distance of register are ignored as outliers
+
+    Args:
+        sdf_grid: [h, w, c] signed distance field of the model
+        origin_point: [3] the (x,y,z) position of voxel [0,0,0] in the model frame
+        res: size of one voxel in meters
+        damping: Levenberg-Marquardt damping added to the normal equations
+        **kwargs: iteration settings of IterativeRegistration
+    """
+    min_correspondences = 6
+
+    def __init__(self, sdf_grid, origin_point, res, damping=1e-6, **kwargs):
+        super().__init__(**kwargs)
+        self.damping = damping
+
+        sdf_grid = np.asarray(sdf_grid, dtype=np.float64)
+        self.field = np.stack([sdf_grid] + np.gradient(sdf_grid, res), axis=-1)
+        self.origin_point = np.asarray(origin_point, dtype=np.float64)
+        self.res = res
+
+    def interpolate(self, points):
+        """
+        Trilinear interpolation of the SDF and its gradient
+
+        Args:
+            points: [n, 3] points in the model frame
+
+        Returns:
+            [n] mask of the points inside the grid, [m, 4] SDF value and gradient of those points
+        """
+        return trilinear_interpolate(self.field, self.origin_point, self.res, points)
+
+    def evaluate(self, points, max_distance):
+        in_bounds, field = self.interpolate(points)
+        inliers = np.abs(field[:, 0]) < max_distance
+        field = field[inliers]
+        fitness = len(field) / max(len(points), 1)
+        rmse = np.sqrt(np.mean(field[:, 0] ** 2)) if len(field) else 0.0
+        return fitness, rmse, (points[in_bounds][inliers], field)
+
+    def step(self, points, correspondences, data, T):
+        # the SDF value is the residual and its gradient the normal, as in point to plane ICP
+        points, field = correspondences
+        J = np.hstack((np.cross(points, field[:, 1:4]), field[:, 1:4]))
+        H = J.T @ J + self.damping * np.eye(6)
+        return twist_to_matrix(np.linalg.solve(H, -J.T @ field[:, 0]))
+
+
+class SDFScorer:
+    """
+    Scores registered points by their SDF value like SDFRegistration.evaluate, interpolating the values only. The
+    SDF is used as it is, so scoring shares the grid of the model instead of building a gradient grid
+
+    Args:
+        sdf_grid: [h, w, c] signed distance field of the model
+        origin_point: [3] the (x,y,z) position of voxel [0,0,0] in the model frame
+        res: size of one voxel in meters
+    """
+
+    def __init__(self, sdf_grid, origin_point, res):
+        self.sdf_grid = np.asarray(sdf_grid)
+        self.origin_point = np.asarray(origin_point, dtype=np.float64)
+        self.res = res
+
+    def evaluate(self, points, max_distance):
+        """
+        Args:
+            points: [n, 3] points in the model frame
+            max_distance: points with a larger absolute SDF value are outliers
+
+        Returns:
+            fitness, inlier rmse and the inlier points with their SDF values
+        """
+        in_bounds, values = trilinear_interpolate(self.sdf_grid, self.origin_point, self.res, points)
+        inliers = np.abs(values) < max_distance
+        values = values[inliers]
+        fitness = len(values) / max(len(points), 1)
+        rmse = np.sqrt(np.mean(values ** 2)) if len(values) else 0.0
+        return fitness, rmse, (points[in_bounds][inliers], values)
@@ -0,0 +1,137 @@
+import numpy as np
+import open3d as o3d
+
+from visual_servoing.registration import RegistrationResult, transform_points
+
+
+class TrackingMonitor:
+    """
+    Judges whether a local registration still tracks the model from its fitness, inlier rmse and the number of
+    segmented points. The fitness and rmse each engine reports depend on its correspondences and correspondence
+    distance, e.g. ICP measures the distance to the nearest model point and a single scale ICP counts far more
+    outliers as inliers than the last level of a multiscale one. So with a scorer every registered pose is scored
+    again the same way, and the bounds hold for every engine
+
+    Args:
+        min_fitness: fewer source points within inlier_distance of the model than this fraction means tracking is
+            lost
+        max_rmse: larger inlier rmse than this in meters means tracking is lost
+        min_points: fewer segmented points than this means tracking is lost
+        min_point_ratio: fewer segmented points than this fraction of the running average of tracked frames means
+            tracking is lost, segmenting at a wrong pose keeps only part of the gripper
+        smoothing: weight of the newest tracked frame in the running average of the point count
+        scorer: scorer or registration whose evaluate scores the registered points, e.g. an SDFScorer of the model,
+            None trusts the fitness and rmse the registration engine reports
+        inlier_distance: points further than this from the model in meters are outliers when scoring
+        max_score_points: scoring uses an evenly strided subset of at most this many points
+    """
+
+    def __init__(self, min_fitness=0.6, max_rmse=0.008, min_points=50, min_point_ratio=0.0, smoothing=0.2,
+                 scorer=None, inlier_distance=0.01, max_score_points=5000):
+        self.min_fitness = min_fitness
+        self.max_rmse = max_rmse
+        self.min_points = min_points
+        self.min_point_ratio = min_point_ratio
+        self.smoothing = smoothing
+        self.scorer = scorer
+        self.inlier_distance = inlier_distance
+        self.max_score_points = max_score_points
+        self.mean_points = None
+
+    def score(self, reg, source):
+        """
+        Args:
+            reg: RegistrationResult of the frame
+            source: [n, 3] registered points
+
+        Returns:
+            fitness and inlier rmse of the registered pose
+        """
+        if self.scorer is None:
+            return reg.fitness, reg.inlier_rmse
+        stride = max(int(np.ceil(len(source) / self.max_score_points)), 1)
+        source = source[::stride]
+        fitness, rmse, _ = self.scorer.evaluate(transform_points(reg.transformation, source), self.inlier_distance)
+        return fitness, rmse
+
+    def is_tracking(self, reg, source):
+        """
+        Args:
+            reg: RegistrationResult of the frame
+            source: [n, 3] segmented points registered
+
+        Returns:
+            True if the registration can be trusted
+        """
+        n_points = len(source)
+        fitness, rmse = self.score(reg, source)
+        tracking = n_points >= self.min_points and fitness >= self.min_fitness and rmse <= self.max_rmse
+        if self.mean_points is not None and n_points < self.min_point_ratio * self.mean_points:
+            tracking = False
+        if tracking:
+            self.update(n_points)
+        return tracking
+
+    def update(self, n_points):
+        # running average of the point count over tracked frames only, so lost frames do not drag it down
+        if self.mean_points is None:
+            self.mean_points = n_points
+        else:
+            self.mean_points += self.smoothing * (n_points - self.mean_points)
+
+
+class GlobalRegistration:
+    """
+    Global registration against a static model with FPFH features and RANSAC, it needs no initial guess and is
+    used to recover once local registration has lost track. The model features are computed once here, only
+    the scene features are computed per registration
+
+    Args:
+        model: [n, 3] model points, the registration target
+        voxel_size: both clouds are downsampled to this voxel size in meters before computing features
+        max_iteration: maximum number of RANSAC iterations
+        confidence: RANSAC stops early once it found a pose with this confidence
+    """
+
+    def __init__(self, model, voxel_size=0.005, max_iteration=100000, confidence=0.999):
+        self.voxel_size = voxel_size
+        self.max_distance = 1.5 * voxel_size
+        self.max_iteration = max_iteration
+        self.confidence = confidence
+        self.model_down, self.model_features = self.compute_features(model)
+
+    def compute_features(self, points):
+        """
+        Args:
+            points: [n, 3] points
+
+        Returns:
+            downsampled o3d point cloud with normals, and its FPFH features
+        """
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(np.asarray(points, dtype=np.float64))
+        pcd = pcd.voxel_down_sample(self.voxel_size)
+        pcd.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=2 * self.voxel_size, max_nn=30))
+        features = o3d.pipelines.registration.compute_fpfh_feature(
+            pcd, o3d.geometry.KDTreeSearchParamHybrid(radius=5 * self.voxel_size, max_nn=100))
+        return pcd, features
+
+    def register(self, source):
+        """
+        Args:
+            source: [n, 3] scene points that may contain the model
+
+        Returns:
+            RegistrationResult taking the source onto the model
+        """
+        source_down, source_features = self.compute_features(source)
+        result = o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
+            source_down, self.model_down, source_features, self.model_features, True, self.max_distance,
+            o3d.pipelines.registration.TransformationEstimationPointToPoint(False), 3,
+            [
+                o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(0.9),
+                o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(self.max_distance)
+            ],
+            o3d.pipelines.registration.RANSACConvergenceCriteria(self.max_iteration, self.confidence)
+        )
+        return RegistrationResult(np.array(result.transformation), result.fitness, result.inlier_rmse)
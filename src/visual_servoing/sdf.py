@@ -0,0 +1,140 @@
+import pickle as pkl
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+class SDFUnpickler(pkl.Unpickler):
+    """
+    Unpickler for the model assets that loads tensors pickled by tensorflow as numpy arrays, so that
+    points_and_sdf.pkl can be read without tensorflow installed
+    """
+
+    def find_class(self, module, name):
+        if module.startswith("tensorflow"):
+            return np.asarray
+        return super().find_class(module, name)
+
+
+def load_sdf(path):
+    """
+    Load a model point cloud and signed distance field pickle
+
+    Args:
+        path: path of the pickle, e.g. points_and_sdf.pkl
+
+    Returns:
+        dict with 'points', 'sdf', 'origin_point' and 'res', tensors converted to numpy arrays
+    """
+    with open(path, "rb") as f:
+        return SDFUnpickler(f).load()
+
+
+def point_to_idx(points, res, origin_point):
+    """
+    Args:
+        points: [n,3] float32 points in the frame of the voxel grid
+        res: scalar, size of one voxel in meters
+        origin_point: [3] the position [x,y,z] of the center of the voxel (0,0,0) in the same frame as points
+
+    Returns:
+        [n,3] int64 voxel indices, rounded half to even like tf.round
+    """
+    return np.round((points - np.float32(origin_point)) / np.float32(res)).astype(np.int64)
+
+
+def _segment_mask_numpy(pc, sdf, origin_point, res, threshold):
+    indices = point_to_idx(pc, res, origin_point)
+    in_bounds = ~(np.any(indices <= 0, axis=-1) | np.any(indices >= sdf.shape, axis=-1))
+    mask = np.zeros(pc.shape[0], dtype=bool)
+    in_bounds_indices = indices[in_bounds]
+    distances = sdf[in_bounds_indices[:, 0], in_bounds_indices[:, 1], in_bounds_indices[:, 2]]
+    mask[in_bounds] = distances < threshold
+    return mask
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _segment_mask_numba(pc, sdf, origin_point, res, threshold):
+        # fused loop over the points, rint rounds half to even like np.round and arithmetic stays in float32
+        mask = np.zeros(pc.shape[0], dtype=np.bool_)
+        for i in range(pc.shape[0]):
+            idx = np.empty(3, dtype=np.int64)
+            in_bounds = True
+            for k in range(3):
+                idx[k] = np.int64(np.rint((pc[i, k] - origin_point[k]) / res))
+                if idx[k] <= 0 or idx[k] >= sdf.shape[k]:
+                    in_bounds = False
+            if in_bounds:
+                mask[i] = sdf[idx[0], idx[1], idx[2]] < threshold
+        return mask
+else:
+    _segment_mask_numba = None
+
+
+def segment_mask(pc, sdf, origin_point, res, threshold):
+    """
+    Find the points close to the model, same semantics as the original tensorflow implementation
+
+    Args:
+        pc: [n, 3], as set of n (x,y,z) points in the same frame as the voxel grid
+        sdf: [h, w, c], signed distance field
+        origin_point: [3], the (x,y,z) position of voxel [0,0,0]
+        res: scalar, size of one voxel in meters
+        threshold: the distance threshold determining what's segmented
+
+    Returns:
+        [n] boolean mask of the points inside the grid whose signed distance is below threshold
+    """
+    pc = np.asarray(pc, dtype=np.float32)
+    sdf = np.asarray(sdf)
+    origin_point = np.asarray(origin_point, dtype=np.float32)
+    if _segment_mask_numba is not None:
+        return _segment_mask_numba(np.ascontiguousarray(pc), sdf, origin_point, np.float32(res),
+                                   sdf.dtype.type(threshold))
+    return _segment_mask_numpy(pc, sdf, origin_point, res, threshold)
+
+
+def segment_mask_tf(pc, sdf, origin_point, res, threshold):
+    """
+    TensorFlow implementation of segment_mask, tensorflow is only imported when it is called
+
+    Args:
+        pc: [n, 3], as set of n (x,y,z) points in the same frame as the voxel grid
+        sdf: [h, w, c], signed distance field
+        origin_point: [3], the (x,y,z) position of voxel [0,0,0]
+        res: scalar, size of one voxel in meters
+        threshold: the distance threshold determining what's segmented
+
+    Returns:
+        [n] boolean mask of the points inside the grid whose signed distance is below threshold
+    """
+    import tensorflow as tf
+    pc = tf.convert_to_tensor(pc, dtype=tf.float32)
+    # helps with stupid numerics issues
+    indices = tf.cast(tf.round((pc - np.float32(origin_point)) / np.float32(res)), tf.int64)
+    shape = tf.constant(np.shape(sdf), dtype=tf.int64)
+    in_bounds = tf.logical_not(tf.logical_or(tf.reduce_any(indices <= 0, -1), tf.reduce_any(indices >= shape, -1)))
+    # out of bounds points read a clamped voxel and are masked out after
+    distances = tf.gather_nd(sdf, tf.clip_by_value(indices, 0, shape - 1))
+    return tf.logical_and(in_bounds, distances < threshold).numpy()
+
+
+def segment(pc, sdf, origin_point, res, threshold):
+    """
+    Args:
+        pc: [n, 3], as set of n (x,y,z) points in the same frame as the voxel grid
+        sdf: [h, w, c], signed distance field
+        origin_point: [3], the (x,y,z) position of voxel [0,0,0]
+        res: scalar, size of one voxel in meters
+        threshold: the distance threshold determining what's segmented
+
+    Returns:
+        [m, 3] float32 segmented points
+    """
+    pc = np.asarray(pc, dtype=np.float32)
+    return pc[segment_mask(pc, sdf, origin_point, res, threshold)]
@@ -16,6 +16,24 @@ def get_link_tf(urdf, idx):
     tf[3, 3] = 1
     return tf
 
+def quaternion_to_matrix(quats):
+    # [n, 4] pybullet (x, y, z, w) quaternions to [n, 3, 3] rotation matrices
+    x, y, z, w = np.asarray(quats, dtype=np.float64).T
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)], axis=-1),
+        np.stack([2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)], axis=-1),
+        np.stack([2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], axis=-1),
+    ], axis=-2)
+
+def get_link_tfs(urdf, indices):
+    # batched get_link_tf, one getLinkStates call for all links, returns [n, 4, 4]
+    states = p.getLinkStates(urdf, indices, computeForwardKinematics=1)
+    tfs = np.zeros((len(indices), 4, 4))
+    tfs[:, 0:3, 0:3] = quaternion_to_matrix([state[5] for state in states])
+    tfs[:, 0:3, 3] = [state[4] for state in states]
+    tfs[:, 3, 3] = 1
+    return tfs
+
 def draw_sphere_marker(position, radius, color):
     vs_id = p.createVisualShape(p.GEOM_SPHERE, radius=radius, rgbaColor=color)
     marker_id = p.createMultiBody(basePosition=position, baseCollisionShapeIndex=-1, baseVisualShapeIndex=vs_id)
@@ -1,9 +1,8 @@
-import pickle
-
 import numpy as np
 import pybullet as p
 from visual_servoing.arm_robot import ArmRobot
-from visual_servoing.utils import get_link_tf
+from visual_servoing.assets import load_asset
+from visual_servoing.utils import get_link_tf, get_link_tfs
 
 # Joint names
 right_arm_joints = [
@@ -59,8 +58,24 @@ class Victor(ArmRobot):
         for joint_name in left_arm_joints:
             self.left_arm_joints.append(self.joints_by_name[joint_name][0])
 
-        # load pickle
-        self.gripper_pkl = pickle.load(open("robot_points.pkl", 'rb'))
+        # load gripper points, shared between instances
+        self.gripper_pkl = load_asset("robot_points.pkl")
+
+        # gripper model cloud, palm first then the finger links, with the index of each point's link as last column
+        self.gripper_links = ["l_palm"] + list(self.gripper_pkl['points'].keys())[10:22]
+        self.gripper_link_idx = [self.links_by_name[link][0] for link in self.gripper_links]
+        sizes = [len(self.gripper_pkl['points'][link]) for link in self.gripper_links]
+        self.gripper_model = np.empty((sum(sizes), 4))
+        offset = 0
+        for i, (link, size) in enumerate(zip(self.gripper_links, sizes)):
+            self.gripper_model[offset:offset + size, 0:3] = self.gripper_pkl['points'][link]
+            self.gripper_model[offset:offset + size, 3] = i
+            offset += size
+        self.gripper_point_link = self.gripper_model[:, 3].astype(np.int64)
+
+        # gripper cloud in palm frame, only regenerated when the finger joints move
+        self.gripper_palm_pcl = None
+        self.gripper_joint_key = None
 
         # set arm states
         if (arm_states is not None):
@@ -87,35 +102,25 @@ class Victor(ArmRobot):
         return Tab
 
     def get_gripper_pcl(self, tf_to_palm):
-        gripper_pcl = []
-
-        link_tf = {}
-        # statically initialize TF from world -> palm
-        link_tf["l_palm"] = tf_to_palm
-        # apply transforms for downstream joints
-        links = list(self.gripper_pkl['points'].keys())[10:22]
-
-        for link in links:
-            link = str(link)
-            link_info = self.links_by_name[link]
-            parent_idx = link_info[16]
-            parent_link = p.getJointInfo(self.urdf, parent_idx)[12].decode("ascii")
-            if (parent_link not in link_tf):
-                print("ERROR")
-            parent_tf = link_tf[parent_link]
-            tf = parent_tf @ self.get_tf(parent_link, link)
-            link_tf[link] = tf
-
-        links.insert(0, "l_palm")
-        for link in links:
-            pts = np.array(self.gripper_pkl['points'][link]).T
-            pts = np.vstack((pts, np.ones(pts.shape[1])))
-            tf = link_tf[link]  # get_link_tf(victor.urdf, victor.links_by_name[link][0])
-            pts_tf = tf @ pts
-            gripper_pcl.append(pts_tf.T)
-        gripper_pcl = np.vstack(gripper_pcl)
-        gripper_pcl = gripper_pcl[:, 0:3]
-        return gripper_pcl
+        """
+        Returns the gripper model cloud posed by the current finger joint configuration
+
+        Args:
+            tf_to_palm: homogenous transform of the palm link in the output frame
+
+        Returns:
+            [n, 3] gripper points, palm points first then the finger links
+        """
+        # finger links have the same index as the joint moving them
+        joint_key = tuple(state[0] for state in p.getJointStates(self.urdf, self.gripper_link_idx[1:]))
+        if joint_key != self.gripper_joint_key:
+            Twl = get_link_tfs(self.urdf, self.gripper_link_idx)
+            Tpl = np.linalg.inv(Twl[0]) @ Twl
+            link_tfs = Tpl[self.gripper_point_link]
+            self.gripper_palm_pcl = np.einsum('nij,nj->ni', link_tfs[:, 0:3, 0:3], self.gripper_model[:, 0:3]) \
+                + link_tfs[:, 0:3, 3]
+            self.gripper_joint_key = joint_key
+        return self.gripper_palm_pcl @ tf_to_palm[0:3, 0:3].T + tf_to_palm[0:3, 3]
 
     def get_eef_pos(self, side):
         """
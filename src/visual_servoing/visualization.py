@@ -0,0 +1,194 @@
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from visual_servoing.utils import draw_pose
+
+
+class VisualizationService:
+    """
+    Keeps debug visualizations from slowing down perception and control code. They only publish snapshots, which
+    go into a bounded queue that drops its oldest snapshot when full. A thread of its own prepares the latest
+    snapshot of every visualization, resizing images and converting clouds, and skips stale ones. GUI toolkits
+    only work reliably on the main thread, so the prepared snapshots are rendered by poll, which the control loop
+    calls from the main thread and which renders at most max_hz times a second. Images are shown with OpenCV,
+    point clouds in an Open3D window and poses as PyBullet debug lines.
+
+    Args:
+        max_hz: maximum rate visualizations are rendered at
+        queue_size: maximum number of snapshots waiting to be rendered
+        enabled: False makes publishing a no-op and starts no thread, for headless runs
+    """
+
+    def __init__(self, max_hz=10.0, queue_size=8, enabled=True):
+        self.period = 1.0 / max_hz
+        self.enabled = enabled
+        self.snapshots = queue.Queue(maxsize=queue_size)
+        self.running = False
+        self.thread = None
+        # latest prepared snapshot of every visualization, handed from the prepare thread to poll
+        self.prepared = {}
+        self.lock = threading.Lock()
+
+        # render state, only touched by the thread calling poll
+        self.last_render = 0.0
+        self.o3d_vis = None
+        self.clouds = {}
+        self.pose_uids = {}
+        if enabled:
+            self.running = True
+            self.thread = threading.Thread(target=self.prepare_loop, daemon=True)
+            self.thread.start()
+
+    def publish(self, kind, name, data):
+        """
+        Queue a snapshot for rendering without blocking, dropping the oldest queued one if the queue is full
+
+        Args:
+            kind: 'image', 'cloud' or 'pose'
+            name: visualization the snapshot replaces, e.g. a window or pose name
+            data: snapshot owned by the service from now on, the publisher must not modify it
+        """
+        if not self.running:
+            return
+        while True:
+            try:
+                self.snapshots.put_nowait((kind, name, data))
+                return
+            except queue.Full:
+                try:
+                    self.snapshots.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def publish_image(self, name, image, size=None):
+        """
+        Show an image in an OpenCV window
+
+        Args:
+            name: window name
+            image: [h, w, 3] BGR image, copied
+            size: optional (w, h) the image is resized to before it is shown
+        """
+        if not self.running:
+            return
+        self.publish('image', name, (image.copy(), size))
+
+    def publish_cloud(self, name, points, color):
+        """
+        Show a point cloud in the Open3D window
+
+        Args:
+            name: cloud name
+            points: [n, 3] points, copied
+            color: [3,] rgb color in [0, 1]
+        """
+        if not self.running:
+            return
+        self.publish('cloud', name, (np.array(points, dtype=np.float64), color))
+
+    def publish_pose(self, name, pose):
+        """
+        Show a pose as PyBullet debug axes, replacing the previous pose of the same name
+
+        Args:
+            name: pose name
+            pose: 4x4 homogenous transform in world frame, copied
+        """
+        if not self.running:
+            return
+        self.publish('pose', name, np.array(pose))
+
+    def prepare(self, kind, data):
+        # the work that needs no GUI, done on the prepare thread
+        if kind == 'image':
+            image, size = data
+            return image if size is None else cv2.resize(image, size)
+        if kind == 'cloud':
+            import open3d as o3d
+            points, color = data
+            return o3d.utility.Vector3dVector(points), color
+        return data
+
+    def prepare_loop(self):
+        while self.running:
+            # the latest snapshot of every visualization, older ones are stale
+            latest = {}
+            try:
+                kind, name, data = self.snapshots.get(timeout=self.period)
+                latest[(kind, name)] = data
+                while True:
+                    kind, name, data = self.snapshots.get_nowait()
+                    latest[(kind, name)] = data
+            except queue.Empty:
+                pass
+
+            prepared = {key: self.prepare(key[0], data) for key, data in latest.items()}
+            with self.lock:
+                self.prepared.update(prepared)
+
+    def poll(self):
+        """
+        Render the latest prepared snapshots and process GUI events, returns right away if called more often than
+        max_hz. Call it regularly from the main thread, e.g. once per control loop iteration
+        """
+        now = time.perf_counter()
+        if not self.running or now - self.last_render < self.period:
+            return
+        self.last_render = now
+        with self.lock:
+            prepared, self.prepared = self.prepared, {}
+
+        for (kind, name), data in prepared.items():
+            if kind == 'image':
+                cv2.imshow(name, data)
+            elif kind == 'cloud':
+                self.render_cloud(name, *data)
+            elif kind == 'pose':
+                self.render_pose(name, data)
+        if any(kind == 'image' for kind, _ in prepared):
+            cv2.waitKey(1)
+        if self.o3d_vis is not None:
+            self.o3d_vis.poll_events()
+            self.o3d_vis.update_renderer()
+
+    def render_cloud(self, name, points, color):
+        import open3d as o3d
+        if self.o3d_vis is None:
+            self.o3d_vis = o3d.visualization.Visualizer()
+            self.o3d_vis.create_window()
+        cloud = self.clouds.get(name)
+        if cloud is None:
+            cloud = o3d.geometry.PointCloud()
+            cloud.points = points
+            cloud.paint_uniform_color(color)
+            self.o3d_vis.add_geometry(cloud)
+            self.clouds[name] = cloud
+        else:
+            cloud.points = points
+            cloud.paint_uniform_color(color)
+            self.o3d_vis.update_geometry(cloud)
+
+    def render_pose(self, name, pose):
+        # debug lines are replaced in place instead of being removed and added again
+        uids = self.pose_uids.get(name)
+        if uids is None:
+            self.pose_uids[name] = draw_pose(pose[0:3, 3], pose[0:3, 0:3], mat=True)
+        else:
+            draw_pose(pose[0:3, 3], pose[0:3, 0:3], uids, mat=True)
+
+    def stop(self):
+        """
+        Stop the prepare thread and close the Open3D window, snapshots not rendered yet are dropped. Call it from
+        the thread calling poll, before disconnecting PyBullet
+        """
+        if self.thread is not None:
+            self.running = False
+            self.thread.join()
+            self.thread = None
+        if self.o3d_vis is not None:
+            self.o3d_vis.destroy_window()
+            self.o3d_vis = None
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from scipy.linalg import expm
+
+from visual_servoing.prediction import MotionPredictor, se3_exp, se3_log, skew
+
+AXIS = np.array([1.0, -2.0, 0.5]) / np.linalg.norm([1.0, -2.0, 0.5])
+V = np.array([0.3, -0.1, 0.2])
+
+
+def twist_matrix(xi):
+    X = np.zeros((4, 4))
+    X[0:3, 0:3] = skew(xi[3:6])
+    X[0:3, 3] = xi[0:3]
+    return X
+
+
+def random_pose(rng):
+    return se3_exp(np.hstack((rng.uniform(-0.5, 0.5, 3), rng.uniform(-1.5, 1.5, 3))))
+
+
+@pytest.mark.parametrize("theta", [0.0, 1e-12, 5e-9, 1e-7, 1e-5, 1e-3, 0.7, 2.5, np.pi - 1e-6])
+def test_exp_log_round_trip(theta):
+    xi = np.hstack((V, AXIS * theta))
+    T = se3_exp(xi)
+    np.testing.assert_allclose(T, expm(twist_matrix(xi)), atol=1e-9)
+    np.testing.assert_allclose(se3_log(T), xi, atol=1e-6)
+    np.testing.assert_allclose(se3_exp(se3_log(T)), T, atol=1e-9)
+
+
+def test_log_of_half_turn():
+    # the rotation axis of a half turn has no sign, but the log still maps back to the same transform
+    T = se3_exp(np.hstack((V, AXIS * np.pi)))
+    xi = se3_log(T)
+    np.testing.assert_allclose(np.linalg.norm(xi[3:6]), np.pi, atol=1e-6)
+    np.testing.assert_allclose(se3_exp(xi), T, atol=1e-6)
+
+
+def test_constant_twist_extrapolation():
+    rng = np.random.default_rng(0)
+    dt = 0.1
+    xi = np.array([0.2, -0.05, 0.1, 0.3, 0.8, -0.4])
+    pose = random_pose(rng)
+
+    predictor = MotionPredictor(velocity_weight=1.0)
+    predictor.reset(pose)
+    predictor.update(se3_exp(xi * dt) @ pose, dt)
+    np.testing.assert_allclose(predictor.velocity, xi, atol=1e-9)
+
+    # with only the estimated velocity the commanded twist is ignored
+    predicted = predictor.predict(random_pose(rng), rng.uniform(-1, 1, 6), dt)
+    np.testing.assert_allclose(predicted, se3_exp(xi * 2 * dt) @ pose, atol=1e-9)
+
+
+def test_commanded_rotation_keeps_the_eef_origin():
+    rng = np.random.default_rng(1)
+    pose = random_pose(rng)
+    Tcw = random_pose(rng)
+    predictor = MotionPredictor()
+    predictor.reset(pose)
+
+    # a pure angular velocity command rotates the end effector about its own link origin
+    predicted = predictor.predict(Tcw, np.array([0.0, 0.0, 0.0, 0.4, -0.2, 0.9]), 0.5)
+    np.testing.assert_allclose(predicted[0:3, 3], pose[0:3, 3], atol=1e-9)
+    Rcw = Tcw[0:3, 0:3]
+    expected = se3_exp(np.hstack((np.zeros(3), Rcw @ np.array([0.4, -0.2, 0.9]) * 0.5)))[0:3, 0:3] @ pose[0:3, 0:3]
+    np.testing.assert_allclose(predicted[0:3, 0:3], expected, atol=1e-9)
+
+
+def test_untrusted_update_keeps_velocity():
+    rng = np.random.default_rng(2)
+    dt = 0.1
+    xi = np.array([0.1, 0.0, -0.2, 0.0, 0.5, 0.1])
+    pose = random_pose(rng)
+    predictor = MotionPredictor(velocity_weight=0.5)
+    predictor.reset(pose)
+    pose = se3_exp(xi * dt) @ pose
+    predictor.update(pose, dt)
+    velocity = predictor.velocity.copy()
+
+    # a relocalization jump is not motion, neither into the untrusted pose nor out of it
+    jumped = random_pose(rng)
+    predictor.update(jumped, dt, trusted=False)
+    np.testing.assert_array_equal(predictor.velocity, velocity)
+    np.testing.assert_array_equal(predictor.pose, jumped)
+    predictor.update(se3_exp(xi * dt) @ jumped, dt)
+    np.testing.assert_array_equal(predictor.velocity, velocity)
+
+    # two trusted poses in a row estimate the velocity again
+    slower = xi / 2
+    predictor.update(se3_exp(slower * dt) @ predictor.pose, dt)
+    np.testing.assert_allclose(predictor.velocity, slower, atol=1e-9)
+
+    predictor.reset(pose)
+    assert predictor.velocity is None
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+# RealsenseCamera works on ROS messages, these tests need a ROS environment
+pytest.importorskip("ros_numpy")
+pytest.importorskip("arc_utilities")
+msg = pytest.importorskip("sensor_msgs.msg")
+
+from visual_servoing.camera import RealsenseCamera
+
+
+def make_info(width, height, fx, fy, cx, cy):
+    info = msg.CameraInfo()
+    info.width = width
+    info.height = height
+    info.K = [fx, 0.0, cx, 0.0, fy, cy, 0.0, 0.0, 1.0]
+    return info
+
+
+def make_image(depth, encoding):
+    image = msg.Image()
+    image.height, image.width = depth.shape
+    image.encoding = encoding
+    image.is_bigendian = 0
+    image.step = depth.shape[1] * depth.itemsize
+    image.data = depth.tobytes()
+    return image
+
+
+def expected_points(depth_m, K):
+    # pinhole deprojection in the optical frame, row major like the depth image
+    v, u = np.mgrid[0:depth_m.shape[0], 0:depth_m.shape[1]]
+    x = (u - K[0, 2]) / K[0, 0] * depth_m
+    y = (v - K[1, 2]) / K[1, 1] * depth_m
+    return np.vstack((x.reshape(-1), y.reshape(-1), depth_m.reshape(-1)))
+
+
+# small 4x3 images with depths from 0.5 m to 1.6 m and one missing reading
+RAW_DEPTH = (np.arange(500, 1700, 100, dtype=np.uint16)).reshape(3, 4)
+RAW_DEPTH[1, 2] = 0
+COLOR_INFO = make_info(4, 3, 600.0, 610.0, 1.5, 1.0)
+
+
+@pytest.mark.parametrize("metric_depth", [False, True])
+def test_16bit_depth_scale(metric_depth):
+    camera = RealsenseCamera(None, None, metric_depth=metric_depth, depth_scale=0.001, color_info=COLOR_INFO)
+    depth = camera.depth_from_msg(make_image(RAW_DEPTH, "16UC1"))
+    if metric_depth:
+        np.testing.assert_allclose(depth, RAW_DEPTH * 0.001)
+    else:
+        np.testing.assert_array_equal(depth, RAW_DEPTH)
+
+    K = np.array(COLOR_INFO.K).reshape(3, 3)
+    np.testing.assert_allclose(camera.get_pointcloud(depth), expected_points(RAW_DEPTH * 0.001, K), atol=1e-9)
+
+
+def test_float_depth_nan_is_missing():
+    depth_m = (RAW_DEPTH * 0.001).astype(np.float32)
+    depth_m[0, 0] = np.nan
+    camera = RealsenseCamera(None, None, metric_depth=True, dtype=np.float32, color_info=COLOR_INFO)
+    depth = camera.depth_from_msg(make_image(depth_m, "32FC1"))
+    assert depth[0, 0] == 0
+    np.testing.assert_allclose(depth[1:], depth_m[1:])
+
+
+def test_get_xyz_matches_pointcloud_in_world():
+    # camera 1 m above the world origin looking down, optical z along world -z
+    Tcw = np.array([[1.0, 0, 0, 0], [0, -1, 0, 0], [0, 0, -1, 1], [0, 0, 0, 1]])
+    camera = RealsenseCamera(None, None, depth_scale=0.001, extrinsics=Tcw, color_info=COLOR_INFO)
+    depth = camera.depth_from_msg(make_image(RAW_DEPTH, "16UC1"))
+
+    u, v = np.array([0, 3, 1]), np.array([0, 2, 1])
+    pts_cam = camera.get_pointcloud(depth).reshape(3, 3, 4)[:, v, u]
+    pts_world = np.linalg.inv(Tcw)[0:3, 0:3] @ pts_cam + np.linalg.inv(Tcw)[0:3, 3:4]
+    np.testing.assert_allclose(camera.get_xyz(u, v, depth), pts_world, atol=1e-9)
+
+    # a pixel on the principal point row lands in the world y = 0 plane, 1.2 m below the camera
+    np.testing.assert_allclose(camera.get_xyz(3, 1, depth), [1.5 / 600.0 * 1.2, 0.0, -0.2], atol=1e-9)
+
+
+def test_unaligned_depth_uses_depth_intrinsics():
+    # depth at half the color resolution with its own intrinsics, as published without alignment
+    depth_info = make_info(4, 3, 300.0, 305.0, 2.0, 1.5)
+    color_info = make_info(8, 6, 600.0, 610.0, 4.0, 3.0)
+    camera = RealsenseCamera(None, None, aligned_depth=False, color_info=color_info, depth_info=depth_info)
+    assert camera.image_dim == (4, 3)
+    np.testing.assert_array_equal(camera.get_intrinsics(), np.array(color_info.K).reshape(3, 3))
+
+    depth = camera.depth_from_msg(make_image(RAW_DEPTH, "16UC1"))
+    K = np.array(depth_info.K).reshape(3, 3)
+    np.testing.assert_allclose(camera.get_pointcloud(depth), expected_points(RAW_DEPTH * 0.001, K), atol=1e-9)
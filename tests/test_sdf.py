@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from visual_servoing import sdf
+
+
+def segment_mask_tensorflow(pc, sdf_grid, origin_point, res, threshold):
+    pytest.importorskip("tensorflow")
+    return sdf.segment_mask_tf(pc, sdf_grid, origin_point, res, threshold)
+
+
+def segment_mask_numba(pc, sdf_grid, origin_point, res, threshold):
+    if sdf._segment_mask_numba is None:
+        pytest.skip("numba is not installed")
+    return sdf.segment_mask(pc, sdf_grid, origin_point, res, threshold)
+
+
+BACKENDS = {
+    "numpy": lambda pc, *args: sdf._segment_mask_numpy(np.asarray(pc, dtype=np.float32), *args),
+    "numba": segment_mask_numba,
+    "tensorflow": segment_mask_tensorflow,
+}
+
+SEG_RANGE = 0.04
+RES = 0.01
+ORIGIN = np.array([-0.1, -0.15, 0.05], dtype=np.float32)
+
+
+def make_scene(seed=0):
+    rng = np.random.default_rng(seed)
+    sdf_grid = rng.uniform(-0.05, 0.15, (20, 30, 16)).astype(np.float32)
+    extent = np.array(sdf_grid.shape) * RES
+
+    # points spread past every side of the grid, so some fall outside it
+    points = [ORIGIN + rng.uniform(-0.1, 1.1, (2000, 3)) * extent]
+
+    # voxel centers whose distance is exactly the segmentation range, they are not segmented
+    at_range = rng.integers(1, np.array(sdf_grid.shape) - 1, (50, 3))
+    sdf_grid[at_range[:, 0], at_range[:, 1], at_range[:, 2]] = np.float32(SEG_RANGE)
+    points.append(ORIGIN + at_range * np.float32(RES))
+
+    # voxel centers on the faces of the grid, the first voxel of an axis counts as outside and the last as inside
+    edges = rng.integers(1, np.array(sdf_grid.shape) - 1, (30, 3))
+    edges[:10, 0] = 0
+    edges[10:20, 1] = sdf_grid.shape[1] - 1
+    edges[20:, 2] = 0
+    sdf_grid[edges[:, 0], edges[:, 1], edges[:, 2]] = -1.0
+    points.append(ORIGIN + edges * np.float32(RES))
+    return np.vstack(points).astype(np.float32), sdf_grid, at_range, edges
+
+
+def test_reference_mask():
+    points, sdf_grid, at_range, edges = make_scene()
+    mask = BACKENDS["numpy"](points, sdf_grid, ORIGIN, RES, SEG_RANGE)
+
+    n_at_range, n_edges = len(at_range), len(edges)
+    assert not mask[-n_edges - n_at_range:-n_edges].any()
+    edge_mask = mask[-n_edges:]
+    assert not edge_mask[:10].any() and edge_mask[10:20].all() and not edge_mask[20:].any()
+
+    indices = np.round((points - ORIGIN) / np.float32(RES)).astype(np.int64)
+    outside = np.any(indices <= 0, axis=1) | np.any(indices >= sdf_grid.shape, axis=1)
+    assert outside.any() and not mask[outside].any()
+    inside = indices[~outside]
+    np.testing.assert_array_equal(mask[~outside], sdf_grid[inside[:, 0], inside[:, 1], inside[:, 2]] < SEG_RANGE)
+    assert mask.any()
+
+
+@pytest.mark.parametrize("backend", ["numba", "tensorflow"])
+def test_backends_match_numpy(backend):
+    points, sdf_grid, _, _ = make_scene(1)
+    expected = BACKENDS["numpy"](points, sdf_grid, ORIGIN, RES, SEG_RANGE)
+    mask = np.asarray(BACKENDS[backend](points, sdf_grid, ORIGIN, RES, SEG_RANGE))
+    assert mask.dtype == bool
+    np.testing.assert_array_equal(mask, expected)
+
+
+def test_segment_keeps_masked_points():
+    points, sdf_grid, _, _ = make_scene(2)
+    mask = sdf.segment_mask(points, sdf_grid, ORIGIN, RES, SEG_RANGE)
+    np.testing.assert_array_equal(sdf.segment(points, sdf_grid, ORIGIN, RES, SEG_RANGE), points[mask])